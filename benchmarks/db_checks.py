@@ -0,0 +1,75 @@
+"""
+Measures the latency of the blacklist check that runs before every command:
+a new connection per check, as it was done before, a SELECT on the shared
+connection, and the in-memory blacklist that `checks.not_blacklisted` uses now.
+
+Run it from the repository root (it needs a config.json, like the bot); it
+uses a temporary database:
+
+    python -m benchmarks.db_checks
+"""
+
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Awaitable, Callable
+
+import aiosqlite
+
+from chatgpt_discord_bot.helpers import checks, db_manager
+
+CHECKS = 2000
+BLACKLISTED_USERS = 100
+
+
+async def measure(name: str, check: Callable[[int], Awaitable]):
+    latencies = []
+    for pos in range(CHECKS):
+        start = time.perf_counter()
+        await check(pos)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{name:<32} p50 {p50 * 1e6:8.1f} us, p99 {p99 * 1e6:8.1f} us")
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        db_manager.DATABASE_PATH = Path(directory) / "database.db"
+        await db_manager.init_db()
+        try:
+            for user_id in range(BLACKLISTED_USERS):
+                await db_manager.add_user_to_blacklist(1_000_000 + user_id)
+
+            async def connection_per_check(user_id: int) -> bool:
+                async with aiosqlite.connect(db_manager.DATABASE_PATH) as db:
+                    async with db.execute(
+                        "SELECT * FROM blacklist WHERE user_id=?", (user_id,)
+                    ) as cursor:
+                        return await cursor.fetchone() is not None
+
+            async def shared_connection(user_id: int) -> bool:
+                db = await db_manager.get_connection()
+                async with db.execute(
+                    "SELECT 1 FROM blacklist WHERE user_id=?", (user_id,)
+                ) as cursor:
+                    return await cursor.fetchone() is not None
+
+            async def not_blacklisted(user_id: int) -> bool:
+                context = SimpleNamespace(author=SimpleNamespace(id=user_id))
+                return await checks.not_blacklisted(context)
+
+            await measure("connection per check (before)", connection_per_check)
+            await measure("SELECT on the shared connection", shared_connection)
+            await measure("checks.not_blacklisted (now)", not_blacklisted)
+        finally:
+            await db_manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
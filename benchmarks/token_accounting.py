@@ -0,0 +1,71 @@
+"""
+Compares the running token total of `Chat` with re-summing the history on
+every `get_tokens` call, as it was done before, on 64-message reply chains.
+
+Run it from the repository root (it needs a config.json, like the bot):
+
+    python -m benchmarks.token_accounting
+"""
+
+import random
+import timeit
+
+from chatgpt_discord_bot.cogs.chatgpt import (
+    MESSAGE_OVERHEAD_TOKENS,
+    REPLY_PRIMING_TOKENS,
+    Chat,
+)
+
+# The longest reply chain the bot follows.
+MESSAGES = 64
+# A compression pass reads the total once per message, plus preprocessing_chat
+# and get_max_tokens.
+CALLS_PER_PASS = MESSAGES + 4
+NUMBER = 2000
+
+WORDS = ["the", "model", "python", "discord", "token", "cache", "reply", "chain"]
+
+
+def get_history(seed: int = 0) -> list[dict]:
+    rnd = random.Random(seed)
+    return [
+        {
+            "role": "user" if pos % 2 else "assistant",
+            "content": " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 200))),
+        }
+        for pos in range(MESSAGES)
+    ]
+
+
+def resum_tokens(history: list[dict]) -> int:
+    return REPLY_PRIMING_TOKENS + sum(
+        item["tokens"] + MESSAGE_OVERHEAD_TOKENS for item in history
+    )
+
+
+def main():
+    chat = Chat(get_history(), client=object())
+    # The running total must stay equal to the sum across edits.
+    chat.set_content(10, "a summary")
+    chat.remove_message(20)
+    chat.insert_message(0, "system", "You are a helpful assistant.")
+    assert chat.get_tokens() == resum_tokens(chat.history)
+
+    def run_pass(get_tokens):
+        for _ in range(CALLS_PER_PASS):
+            get_tokens()
+
+    resum = timeit.timeit(
+        lambda: run_pass(lambda: resum_tokens(chat.history)), number=NUMBER
+    )
+    running = timeit.timeit(lambda: run_pass(chat.get_tokens), number=NUMBER)
+    print(
+        f"{MESSAGES} messages, {CALLS_PER_PASS} get_tokens calls per compression pass"
+    )
+    print(f"re-summed:     {resum / NUMBER * 1e6:8.1f} us per pass")
+    print(f"running total: {running / NUMBER * 1e6:8.1f} us per pass")
+    print(f"speedup:       {resum / running:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares the tokenizer paths on realistic 64-message histories: the former
+`lru_cache` keyed by the whole text, which resolved the encoding on every miss,
+against the hashed token cache and the batch encoding.
+
+Run it from the repository root (it needs a config.json, like the bot):
+
+    python -m benchmarks.tokenizer
+"""
+
+import random
+import sys
+import time
+from functools import lru_cache
+from typing import Callable
+
+import tiktoken
+
+from chatgpt_discord_bot.helpers import openai as tokenizer
+
+MODEL = "gpt-3.5-turbo"
+MESSAGES = 64
+RUNS = 20
+
+WORDS = ["the", "model", "python", "discord", "token", "cache", "reply", "chain"]
+
+
+def get_history(seed: int) -> list[str]:
+    rnd = random.Random(seed)
+    history = []
+    for pos in range(MESSAGES):
+        # Every 16th message is an attachment of about 50 KB.
+        size = 8000 if pos % 16 == 0 else rnd.randint(20, 120)
+        history.append(" ".join(rnd.choice(WORDS) for _ in range(size)))
+    return history
+
+
+@lru_cache(maxsize=256, typed=True)
+def lru_get_tokens(model: str, text: str) -> int:
+    return len(tiktoken.encoding_for_model(model).encode(text))
+
+
+def measure(name: str, count: Callable[[list[str]], list[int]]):
+    # Cold: new histories, so every text misses the cache.
+    start = time.perf_counter()
+    for seed in range(RUNS):
+        count(get_history(1000 + seed))
+    cold = (time.perf_counter() - start) / RUNS
+
+    # Warm: a chain rebuilt again, as on every reply to it.
+    history = get_history(0)
+    count(history)
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        count(history)
+    warm = (time.perf_counter() - start) / RUNS
+    print(
+        f"{name:<32} cold {cold * 1e3:7.2f} ms, warm {warm * 1e3:7.3f} ms per history"
+    )
+
+
+def main():
+    # Loaded once up front, so no path pays for it.
+    tokenizer.get_encoding(MODEL)
+    measure(
+        "lru_cache of the whole text",
+        lambda history: [lru_get_tokens(MODEL, text) for text in history],
+    )
+    measure(
+        "hashed cache, per message",
+        lambda history: [tokenizer.get_tokens(MODEL, text) for text in history],
+    )
+    measure(
+        "hashed cache, get_tokens_batch",
+        lambda history: tokenizer.get_tokens_batch(MODEL, history),
+    )
+
+    # What the keys of each cache keep alive.
+    lru_bytes = sum(sys.getsizeof(text) for text in get_history(0))
+    hashed_bytes = sum(
+        sys.getsizeof(tokenizer.get_token_cache_key(MODEL, text)[1])
+        for text in get_history(0)
+    )
+    print(
+        f"Key memory of one history: {lru_bytes / 1024:.0f} KiB as texts,"
+        f" {hashed_bytes / 1024:.1f} KiB as digests"
+    )
+
+
+if __name__ == "__main__":
+    main()
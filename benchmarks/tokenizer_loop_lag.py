@@ -0,0 +1,87 @@
+"""
+Measures how late the event loop runs while large attachments are tokenized,
+inline with `get_tokens` and offloaded with `aget_tokens`.
+
+Run it from the repository root (it needs a config.json, like the bot):
+
+    python -m benchmarks.tokenizer_loop_lag [--max-lag-ms 25]
+
+It exits with 1 if the offloaded lag goes over --max-lag-ms.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from typing import Awaitable, Callable
+
+from chatgpt_discord_bot.helpers import openai as tokenizer
+
+MODEL = "gpt-3.5-turbo"
+ATTACHMENTS = 16
+# About the 64 KB an attachment may have.
+ATTACHMENT_WORDS = 13000
+# How often the probe wakes up, like the gateway heartbeat and other commands would.
+PROBE_INTERVAL = 0.005
+
+
+async def probe_lag(stop: asyncio.Event, lags: list[float]):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(loop.time() - start - PROBE_INTERVAL)
+
+
+async def measure(name: str, count: Callable[[str], Awaitable[int]]) -> float:
+    """
+    :return: The largest lag of the event loop, in seconds.
+    """
+    # Different texts, so every run misses the token cache.
+    texts = [
+        " ".join(["token"] * ATTACHMENT_WORDS) + f" {name} {pos}"
+        for pos in range(ATTACHMENTS)
+    ]
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(probe_lag(stop, lags))
+    await asyncio.sleep(PROBE_INTERVAL * 4)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(count(text) for text in texts))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+
+    max_lag = max(lags)
+    print(
+        f"{name}: {ATTACHMENTS} x 64 KB in {elapsed * 1000:.0f} ms,"
+        f" max loop lag {max_lag * 1000:.1f} ms"
+    )
+    return max_lag
+
+
+async def inline(text: str) -> int:
+    return tokenizer.get_tokens(MODEL, text)
+
+
+async def offloaded(text: str) -> int:
+    return await tokenizer.aget_tokens(MODEL, text)
+
+
+async def main(max_lag_ms: float) -> int:
+    # Loaded once up front, so neither run pays for it.
+    tokenizer.get_encoding(MODEL)
+    await measure("inline get_tokens", inline)
+    max_lag = await measure("offloaded aget_tokens", offloaded)
+    if max_lag * 1000 > max_lag_ms:
+        print(f"FAIL: the offloaded lag is over {max_lag_ms} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--max-lag-ms", type=float, default=25.0)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.max_lag_ms)))
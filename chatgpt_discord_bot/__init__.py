@@ -9,14 +9,15 @@ Version: 5.5.0
 import asyncio
 import json
 import logging
+import logging.handlers
 import os
 import platform
+import queue
 import random
 import shutil
 import sys
 from pathlib import Path
 
-import aiosqlite
 import discord
 import openai
 import tiktoken
@@ -24,7 +25,13 @@ from discord.ext import commands, tasks
 from discord.ext.commands import Bot, Context
 
 import chatgpt_discord_bot.exceptions
-from chatgpt_discord_bot.helpers import secrets
+from chatgpt_discord_bot.helpers import db_manager, secrets
+from chatgpt_discord_bot.helpers.metrics import MetricsServer
+from chatgpt_discord_bot.helpers.openai import OpenAIClientManager
+from chatgpt_discord_bot.helpers.quotas import QuotaEngine
+from chatgpt_discord_bot.helpers.scheduler import RequestScheduler
+from chatgpt_discord_bot.helpers.tracing import RequestProfiler, Tracer
+from chatgpt_discord_bot.helpers.usage import UsageLedger
 
 package_dir = Path(__file__).parent
 package_name = package_dir.name
@@ -117,14 +124,22 @@ class LoggingFormatter(logging.Formatter):
         logging.CRITICAL: red + bold,
     }
 
+    def __init__(self):
+        super().__init__()
+        # Built once per level instead of once per record.
+        self.formatters = {}
+        for levelno, log_color in self.COLORS.items():
+            format = "(black){asctime}(reset) (levelcolor){levelname:<8}(reset) (green){name}(reset) {message}"
+            format = format.replace("(black)", self.black + self.bold)
+            format = format.replace("(reset)", self.reset)
+            format = format.replace("(levelcolor)", log_color)
+            format = format.replace("(green)", self.green + self.bold)
+            self.formatters[levelno] = logging.Formatter(
+                format, "%Y-%m-%d %H:%M:%S", style="{"
+            )
+
     def format(self, record):
-        log_color = self.COLORS[record.levelno]
-        format = "(black){asctime}(reset) (levelcolor){levelname:<8}(reset) (green){name}(reset) {message}"
-        format = format.replace("(black)", self.black + self.bold)
-        format = format.replace("(reset)", self.reset)
-        format = format.replace("(levelcolor)", log_color)
-        format = format.replace("(green)", self.green + self.bold)
-        formatter = logging.Formatter(format, "%Y-%m-%d %H:%M:%S", style="{")
+        formatter = self.formatters.get(record.levelno, self.formatters[logging.INFO])
         return formatter.format(record)
 
 
@@ -141,9 +156,15 @@ file_handler_formatter = logging.Formatter(
 )
 file_handler.setFormatter(file_handler_formatter)
 
+# The handlers run on a listener thread, so logging never blocks the event loop.
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue, console_handler, file_handler, respect_handler_level=True
+)
+log_listener.start()
+
 # Add the handlers
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
 bot.logger = logger
 
 
@@ -166,10 +187,8 @@ def init_openai():
 
 
 async def init_db():
-    async with aiosqlite.connect(str(repo_dir / "database.db")) as db:
-        with open(str(package_dir / "database/schema.sql")) as file:
-            await db.executescript(file.read())
-        await db.commit()
+    # The connection stays open for the lifetime of the bot, see `run_bot`.
+    await db_manager.init_db()
 
 
 """
@@ -181,6 +200,69 @@ The config is available using the following code:
 """
 bot.config = config
 
+"""
+The OpenAI client is shared by the whole bot, so every request reuses the same connection pool.
+
+- bot.openai.client # The pooled openai.AsyncOpenAI client
+"""
+openai_clients = OpenAIClientManager.from_config(config)
+bot.openai = openai_clients
+
+"""
+Every OpenAI request waits for its turn in the scheduler, which keeps the bot under the rate limits.
+
+- bot.scheduler.request(tokens, ...) # The async context manager which holds a turn
+"""
+openai_scheduler = RequestScheduler.from_config(config)
+bot.scheduler = openai_scheduler
+
+"""
+The token usage is aggregated per day, guild, user and model, and written to the database in batches.
+
+- bot.usage.total_tokens # The tokens used since the database was created
+- bot.usage.total_cost # The cost in $ of those tokens
+"""
+usage_ledger = UsageLedger()
+bot.usage = usage_ledger
+
+"""
+The quotas of requests and tokens per user, guild and channel, checked before a request is sent.
+
+- bot.quotas.reserve(ids, tokens) # Raises `QuotaExceeded` when a quota is used up
+"""
+quota_engine = QuotaEngine.from_config(config)
+bot.quotas = quota_engine
+
+"""
+The metrics are served in the Prometheus text format at http://metrics_host:metrics_port/metrics, if a port is set.
+"""
+metrics_server = MetricsServer.from_config(config)
+
+"""
+The steps of a request are traced in spans, which are dropped, logged or exported depending on `tracing_sink`.
+The owners can profile the next requests with the `profile` command.
+
+- tracer.span(name, **attributes) # The context manager of a span
+- bot.profiler.start(requests) # The future of the profile report
+"""
+tracer = Tracer.from_config(config)
+bot.profiler = RequestProfiler()
+
+
+@bot.event
+async def setup_hook() -> None:
+    """
+    The code in this event is executed once, on the bot's event loop, before it connects to Discord.
+    """
+    await init_db()
+    await usage_ledger.load()
+    quota_engine.load(await db_manager.get_quota_usage())
+    await load_cogs()
+    await tracer.sink.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+        bot.logger.info(f"Serving metrics on port {metrics_server.port}")
+
 
 @bot.event
 async def on_ready() -> None:
@@ -237,7 +319,7 @@ async def on_command_error(context: Context, error) -> None:
     :param context: The context of the normal command that failed executing.
     :param error: The error that has been faced.
     """
-    if isinstance(error, commands.CommandOnCooldown):
+    if isinstance(error, (commands.CommandOnCooldown, exceptions.QuotaExceeded)):
         minutes, seconds = divmod(error.retry_after, 60)
         hours, minutes = divmod(minutes, 60)
         hours = hours % 24
@@ -322,11 +404,47 @@ async def load_cogs() -> None:
                 bot.logger.error(f"Failed to load extension {extension}\n{exception}")
 
 
+async def run_bot() -> None:
+    """
+    The code in this function runs the bot and releases the shared resources once it is closed.
+    """
+    try:
+        async with bot:
+            await bot.start(secrets.try_get_password(config["token"]))
+    finally:
+        # A failed step must not skip the next ones: the connection has to be
+        # closed last, as its thread would keep the process alive.
+        steps = [tracer.sink.close, usage_ledger.flush, save_quota_usage]
+        if metrics_server is not None:
+            steps.insert(0, metrics_server.close)
+        try:
+            for step in steps:
+                try:
+                    await step()
+                except Exception as e:
+                    bot.logger.error(f"Failed to shut down cleanly: {e!r}")
+        finally:
+            await db_manager.close()
+
+
+async def save_quota_usage() -> None:
+    """
+    The code in this function saves the quota windows, so a restart does not reset them.
+    """
+    await db_manager.replace_quota_usage(quota_engine.get_rows())
+
+
 def main():
     init_openai()
-    asyncio.run(init_db())
-    asyncio.run(load_cogs())
-    bot.run(secrets.try_get_password(config["token"]))
+    # Like `bot.run`, only for the discord logger; the package logs through the queue.
+    discord.utils.setup_logging(root=False)
+    try:
+        asyncio.run(run_bot())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Writes out the queued records.
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -6,46 +6,169 @@ Copyright (c) 2023 EcmaXp
 
 from __future__ import annotations
 
+import asyncio
 import io
-from collections import defaultdict
+import json
+import logging
+import time
+from contextlib import AsyncExitStack
 from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timezone
 from hashlib import sha256
-from typing import List, Optional, cast
+from typing import (
+    AsyncContextManager,
+    AsyncIterator,
+    Callable,
+    Container,
+    List,
+    Optional,
+    cast,
+)
 
 import discord
 import openai
 from async_lru import alru_cache
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands.view import StringView
-
-from chatgpt_discord_bot import config
-from chatgpt_discord_bot.helpers import checks
-from chatgpt_discord_bot.helpers.openai import get_tokens
+from openai.types import CompletionUsage
+
+from chatgpt_discord_bot import (
+    config,
+    openai_clients,
+    openai_scheduler,
+    tracer,
+    usage_ledger,
+)
+from chatgpt_discord_bot.exceptions import QuotaExceeded
+from chatgpt_discord_bot.helpers import checks, db_manager
+from chatgpt_discord_bot.helpers.cache import LRUCache, ReplyIndex
+from chatgpt_discord_bot.helpers.context import (
+    ContextStrategy,
+    create_context_strategy,
+)
+from chatgpt_discord_bot.helpers.conversations import (
+    ConversationStore,
+    ConversationWriter,
+    load_history,
+)
+from chatgpt_discord_bot.helpers.metrics import REGISTRY
+from chatgpt_discord_bot.helpers.models import ModelInfo, get_model_info
+from chatgpt_discord_bot.helpers.openai import (
+    aget_tokens_batch,
+    get_token_cache_size,
+    get_tokens,
+    get_tokens_batch,
+)
+from chatgpt_discord_bot.helpers.resilience import CompletionEngine
+from chatgpt_discord_bot.helpers.quotas import QuotaEngine, get_quota_ids
+from chatgpt_discord_bot.helpers.responses import (
+    FRESH_PREFIX,
+    CachedResponse,
+    ResponseCache,
+    get_response_key,
+)
+from chatgpt_discord_bot.helpers.scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    RequestCoalescer,
+    RequestScheduler,
+)
+from chatgpt_discord_bot.helpers.summaries import SummaryCache
+from chatgpt_discord_bot.helpers.transcripts import TranscriptWriter
+from chatgpt_discord_bot.helpers.usage import UsageLedger
 from chatgpt_discord_bot.helpers.utils import removeprefix
 
 __author__ = "EcmaXp <ecmaxp@ecmaxp.kr>"
 __version__ = "0.2"
 
-COMPRESS_THRESHOLD_TOKEN = 1024
-MAX_TOTAL_TOKEN = 4096
-MAX_PROMPT_TOKEN = 8192
+logger = logging.getLogger(__name__)
+
+# The limits of each model are in `helpers.models`; messages over this share of
+# the context window are summarized when the prompt does not fit.
+COMPRESS_THRESHOLD_RATIO = 0.25
+SUMMARY_MAX_TOKEN = 512
+SUMMARY_EXPECTED_TOKEN = 256
+# Left free for the answer when the prompt is shortened (at most the max output).
+CONTEXT_RESERVE_TOKEN = 1024
+SUMMARY_PROMPT = "Summarize the following:"
+STREAM_PLACEHOLDER = "..."
+
+# Chat format overhead: every reply is primed with 2 tokens,
+# and every message is wrapped by 5 tokens (role, separators).
+REPLY_PRIMING_TOKENS = 2
+MESSAGE_OVERHEAD_TOKENS = 5
+
+# Shared by every summary, so popular pastes are summarized once across restarts.
+summary_cache = SummaryCache.from_config(config)
+completion_coalescer = RequestCoalescer()
+completion_engine = CompletionEngine.from_config(config)
+response_cache = ResponseCache.from_config(config)
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "chatgpt_stage_seconds", "Time spent in each stage of an answer", ["stage"]
+)
+FETCH_CHAIN_SECONDS = STAGE_SECONDS.labels("fetch_chain")
+FETCH_ATTACHMENT_SECONDS = STAGE_SECONDS.labels("fetch_attachment")
+TOKENIZE_SECONDS = STAGE_SECONDS.labels("tokenize")
+COMPRESS_SECONDS = STAGE_SECONDS.labels("compress")
+COMPLETION_SECONDS = STAGE_SECONDS.labels("completion")
+REPLY_SECONDS = STAGE_SECONDS.labels("reply")
+TOKENS = REGISTRY.counter("chatgpt_tokens_total", "Tokens used", ["kind"])
+PROMPT_TOKENS = TOKENS.labels("prompt")
+COMPLETION_TOKENS = TOKENS.labels("completion")
+ERRORS = REGISTRY.counter("chatgpt_errors_total", "Failed answers", ["type"])
+# Read from the caches when collected.
+CACHE_HITS = REGISTRY.counter("chatgpt_cache_hits_total", "Cache hits", ["cache"])
+CACHE_HITS.labels("summary").callback = lambda: summary_cache.hits
+CACHE_HITS.labels("response").callback = lambda: response_cache.hits
+CACHE_MISSES = REGISTRY.counter("chatgpt_cache_misses_total", "Cache misses", ["cache"])
+CACHE_MISSES.labels("summary").callback = lambda: summary_cache.misses
+CACHE_MISSES.labels("response").callback = lambda: response_cache.misses
+
 
 class Chat:
-    def __init__(self, history: list[dict] = None, context: commands.Context = None):
+    def __init__(
+        self,
+        history: list[dict] = None,
+        context: commands.Context = None,
+        *,
+        client: Optional[openai.AsyncOpenAI] = None,
+    ):
         self.history = history or []
         self.context = context
         self.last_completion = None
-        self.openai = openai.AsyncOpenAI(api_key=openai.api_key)
+        self.last_usage: Optional[CompletionUsage] = None
+        # The model which served the last answer, which may be a fallback model.
+        self.last_model: Optional[str] = None
+        if client is None:
+            clients = context.bot.openai if context else openai_clients
+            client = clients.client
+
+        self.openai = client
+        self.scheduler: RequestScheduler = (
+            context.bot.scheduler if context else openai_scheduler
+        )
+        self.usage: UsageLedger = context.bot.usage if context else usage_ledger
+        # Chats without a command, like summaries, wait behind the replies.
+        self.priority = PRIORITY_INTERACTIVE if context else PRIORITY_BACKGROUND
+        self.on_queue_position: Optional[Callable[[int], None]] = None
+        # Whether a completion was requested, and how much of it was streamed.
+        self.requested = False
+        self.streamed_tokens = 0
         self.config = context.bot.config if context else config
         self.user = (
             sha256(str(context.author.id).encode()).hexdigest() if context else None
         )
 
+        items = [item for item in self.history if item.get("tokens") is None]
+        texts = [item["content"] for item in items]
+        for item, tokens in zip(items, get_tokens_batch(self.get_model(), texts)):
+            item["tokens"] = tokens
+
+        self.tokens = REPLY_PRIMING_TOKENS
         for item in self.history:
-            if item.get("tokens") is None:
-                item["tokens"] = get_tokens(self.get_model(), item["content"])
+            self.tokens += item["tokens"] + MESSAGE_OVERHEAD_TOKENS
 
     def __bool__(self):
         return bool(self.history)
@@ -59,109 +182,540 @@ class Chat:
     def __iter__(self):
         return iter(self.history)
 
-    async def completion(self, *, max_tokens: int = MAX_TOTAL_TOKEN):
-        max_tokens = min(max(self.get_max_tokens(), 0), max_tokens)
-        if not max_tokens:
-            raise ValueError("All tokens are used up, start a new chat please.")
+    @tracer.traced("completion")
+    async def completion(self, *, max_tokens: Optional[int] = None):
+        max_tokens = self.get_completion_max_tokens(max_tokens)
+        # Identical requests in flight, like a burst of the same question, share one.
+        return await completion_coalescer.run(
+            self.get_completion_key(max_tokens),
+            lambda: self.scheduled_completion(max_tokens),
+        )
+
+    async def scheduled_completion(self, max_tokens: int):
+        self.requested = True
+        # Each attempt, hedge and fallback waits for its own turn, so the rate
+        # limits count every request sent, and a backoff holds no slot.
+        completion = await completion_engine.call(
+            self.get_models(),
+            lambda model: self.scheduled_model_completion(model, max_tokens),
+        )
+        # Counted once, by the chat which sent the request.
+        self.add_usage(completion.usage, completion.model)
+        return completion
+
+    async def scheduled_model_completion(self, model: str, max_tokens: int):
+        async with self.schedule(max_tokens):
+            return await self.create_model_completion(model, max_tokens)
 
+    def get_completion_key(self, max_tokens: int) -> str:
+        data = json.dumps(
+            [self.get_model(), self.get_messages(), max_tokens], ensure_ascii=False
+        )
+        return sha256(data.encode("utf-8")).hexdigest()
+
+    async def create_stream(self, max_tokens: int, turns: AsyncExitStack):
+        """
+        :param turns: Keeps the turn of the attempt which succeeded, to be held until the stream is read.
+        """
+        self.requested = True
+
+        async def request(model: str):
+            async with AsyncExitStack() as attempt:
+                await attempt.enter_async_context(self.schedule(max_tokens))
+                stream = await self.create_model_completion(model, max_tokens, True)
+                turns.push_async_exit(attempt.pop_all())
+            return stream
+
+        # A stream is not hedged; a second one would have nowhere to go.
+        return await completion_engine.call(self.get_models(), request, hedge=False)
+
+    async def create_model_completion(
+        self, model: str, max_tokens: int, stream: bool = False
+    ):
+        # A fallback model may have smaller limits.
+        info = get_model_info(model, self.config.get("openai_models"))
+        max_tokens = min(
+            max_tokens,
+            info.max_output_tokens,
+            info.context_window - self.get_tokens() - 1,
+        )
         completion = await self.openai.chat.completions.create(
-            model=self.get_model(),
+            model=model,
             messages=self.get_messages(),
             max_tokens=max_tokens,
             user=self.user or "",
+            stream=stream,
         )
         return completion
 
-    async def ask(self, text: Optional[str] = None, *, max_tokens: int = MAX_TOTAL_TOKEN):
+    def get_models(self) -> list[str]:
+        """
+        The model, then the fallback models which can fit the prompt.
+        """
+        models = [self.get_model()]
+        for model in self.config.get("openai_fallback_models", []):
+            info = get_model_info(model, self.config.get("openai_models"))
+            if model not in models and info.context_window > self.get_tokens() + 1:
+                models.append(model)
+        return models
+
+    def get_completion_max_tokens(self, max_tokens: Optional[int] = None) -> int:
+        # Checked locally, so an oversized request never makes a round-trip.
+        max_tokens = min(
+            max(self.get_max_tokens(), 0),
+            self.get_model_info().max_output_tokens,
+            max_tokens or self.get_model_info().max_output_tokens,
+        )
+        if not max_tokens:
+            raise ValueError("All tokens are used up, start a new chat please.")
+        return max_tokens
+
+    def schedule(self, max_tokens: int) -> AsyncContextManager:
+        # The API counts max_tokens against the tokens per minute, so it is charged too.
+        guild = getattr(self.context, "guild", None)
+        return self.scheduler.request(
+            self.get_tokens() + max_tokens,
+            guild_id=guild.id if guild else None,
+            user_id=self.context.author.id if self.context else None,
+            priority=self.priority,
+            on_position=self.on_queue_position,
+        )
+
+    async def ask(
+        self, text: Optional[str] = None, *, max_tokens: Optional[int] = None
+    ):
         if text is not None:
             self.add_message("user", text)
         completion = await self.completion(max_tokens=max_tokens)
         response = completion.choices[0].message.content.strip()
-        if self.config:
-            self.config["chatgpt_tokens_count"] += completion.usage.total_tokens
         self.last_completion = completion
+        self.last_model = completion.model
+        self.last_usage = completion.usage
         self.add_message("assistant", response)
         return response
 
+    async def ask_stream(
+        self,
+        text: Optional[str] = None,
+        *,
+        max_tokens: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        if text is not None:
+            self.add_message("user", text)
+        prompt_tokens = self.get_tokens()
+        max_tokens = self.get_completion_max_tokens(max_tokens)
+        chunks = []
+        model = self.get_model()
+        # The turn is held until the stream is finished.
+        async with AsyncExitStack() as turns:
+            stream = await self.create_stream(max_tokens, turns)
+            async for chunk in stream:
+                model = chunk.model or model
+                if not chunk.choices:
+                    continue
+
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    # A chunk carries about one token.
+                    self.streamed_tokens += 1
+                    chunks.append(delta)
+                    yield delta
+
+        # Streamed responses carry no usage, so it is estimated locally.
+        response = "".join(chunks).strip()
+        completion_tokens = get_tokens(self.get_model(), response)
+        self.last_completion = None
+        self.last_model = model
+        self.add_usage(
+            CompletionUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+            model,
+        )
+        self.add_message("assistant", response)
+
+    def add_usage(self, usage: CompletionUsage, model: Optional[str] = None):
+        model = model or self.get_model()
+        info = get_model_info(model, self.config.get("openai_models"))
+        self.usage.add(
+            self.context.guild.id if self.context and self.context.guild else None,
+            self.context.author.id if self.context else None,
+            model,
+            usage.prompt_tokens,
+            usage.completion_tokens,
+            info.get_cost(usage.prompt_tokens, usage.completion_tokens),
+        )
+        PROMPT_TOKENS.inc(usage.prompt_tokens)
+        COMPLETION_TOKENS.inc(usage.completion_tokens)
+        self.last_usage = usage
+
     def add_message(self, role: str, content: str):
-        self.history.append(
+        self.insert_message(len(self.history), role, content)
+
+    def insert_message(self, index: int, role: str, content: str):
+        tokens = get_tokens(self.get_model(), content)
+        self.history.insert(
+            index,
             {
                 "role": role,
                 "content": content,
-                "tokens": get_tokens(self.get_model(), content),
-            }
+                "tokens": tokens,
+            },
         )
+        self.tokens += tokens + MESSAGE_OVERHEAD_TOKENS
+
+    def remove_message(self, index: int) -> dict:
+        item = self.history.pop(index)
+        self.tokens -= item["tokens"] + MESSAGE_OVERHEAD_TOKENS
+        return item
+
+    def set_content(self, index: int, content: str):
+        item = self.history[index]
+        tokens = get_tokens(self.get_model(), content)
+        self.tokens += tokens - item["tokens"]
+        item["content"] = content
+        item["tokens"] = tokens
 
     def get_model(self) -> str:
         return self.config["openai_chatgpt_model"]
 
+    def get_model_info(self) -> ModelInfo:
+        return get_model_info(self.get_model(), self.config.get("openai_models"))
+
     def get_messages(self) -> list[dict]:
         return [
             {"role": item["role"], "content": item["content"]} for item in self.history
         ]
 
     def get_max_tokens(self) -> int:
-        return MAX_TOTAL_TOKEN - self.get_tokens() - 1
+        return self.get_model_info().context_window - self.get_tokens() - 1
+
+    def get_max_prompt_tokens(self, reserve_tokens: int = CONTEXT_RESERVE_TOKEN) -> int:
+        info = self.get_model_info()
+        return info.context_window - min(reserve_tokens, info.max_output_tokens)
 
     def get_tokens(self) -> int:
-        return 2 + sum(item["tokens"] + 5 for item in self.history)
+        return self.tokens
 
     def copy(self):
-        return Chat(deepcopy(self.history), self.context)
-
-    def print(self, message: discord.Message | None = None):
-        print()
-        if getattr(message, "jump_url", None):
-            print("#", message.jump_url)
-        print(f"{message.author} @ {datetime.now().replace(microsecond=0)}:")
-        for no, item in enumerate(self.history):
-            print(f"{item['role']}: {item['content']}")
-
-        if self.last_completion is not None:
-            usage = self.last_completion.usage
-            print(f"{usage.completion_tokens = }")
-            print(f"{usage.prompt_tokens = }")
-            print(f"{usage.total_tokens = }")
-
+        return Chat(deepcopy(self.history), self.context, client=self.openai)
+
+    def get_transcript(self, message: discord.Message | None = None) -> dict:
+        """
+        :return: A JSON-serializable record of the chat, for the transcript log.
+        """
+        usage = self.last_usage
+        return {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "url": getattr(message, "jump_url", None),
+            "author": str(message.author) if message else None,
+            "model": self.get_model(),
+            "messages": [
+                {
+                    "role": item["role"],
+                    "content": item["content"],
+                    "tokens": item["tokens"],
+                }
+                for item in self.history
+            ],
+            "usage": usage.model_dump() if usage is not None else None,
+        }
+
+    @tracer.traced("compress_large_messages")
     async def compress_large_messages(
         self,
-        threshold_tokens: int = COMPRESS_THRESHOLD_TOKEN,
-        max_prompt_tokens: int = MAX_PROMPT_TOKEN,
+        threshold_tokens: Optional[int] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
-        if self.get_tokens() < max_prompt_tokens:
-            return
+        concurrency = self.config.get("chatgpt_summary_concurrency", 4)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get_summary(pos: int) -> str:
+            async with semaphore:
+                return await self.get_summary(self.history[pos]["content"])
+
+        # Summaries are planned with an expected size; if they turn out longer,
+        # another round summarizes the next biggest messages.
+        summarized = set()
+        while plan := self.plan_compression(
+            threshold_tokens, max_prompt_tokens, exclude=summarized
+        ):
+            summarized.update(plan)
+            tasks = [asyncio.create_task(get_summary(pos)) for pos in plan]
+            try:
+                summaries = await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
 
-        model = self.get_model()
-        for pos, item in enumerate(self.history[3:-3]):
-            if self.get_tokens() < max_prompt_tokens:
+            # Applied only once every summary of the round succeeded.
+            for pos, summary in zip(plan, summaries):
+                self.set_content(pos, summary)
+
+    def plan_compression(
+        self,
+        threshold_tokens: Optional[int] = None,
+        max_prompt_tokens: Optional[int] = None,
+        exclude: Container[int] = (),
+    ) -> list[int]:
+        """
+        Pick the positions of the messages to summarize, biggest savings first,
+        until the prompt is expected to fit under max_prompt_tokens.
+        """
+        if threshold_tokens is None:
+            context_window = self.get_model_info().context_window
+            threshold_tokens = int(context_window * COMPRESS_THRESHOLD_RATIO)
+        if max_prompt_tokens is None:
+            max_prompt_tokens = self.get_max_prompt_tokens()
+
+        excess_tokens = self.get_tokens() - max_prompt_tokens + 1
+        if excess_tokens <= 0:
+            return []
+
+        candidates = [
+            pos
+            for pos in range(3, len(self.history) - 3)
+            if pos not in exclude
+            and self.history[pos]["role"] != "system"
+            and self.history[pos]["tokens"] > threshold_tokens
+        ]
+        candidates.sort(key=lambda pos: self.history[pos]["tokens"], reverse=True)
+
+        plan = []
+        for pos in candidates:
+            if excess_tokens <= 0:
                 break
 
-            if item["role"] == "system":
-                continue
-            elif item["tokens"] > threshold_tokens:
-                item["content"] = await self.get_summary(item["content"])
-                item["tokens"] = get_tokens(model, item["content"])
+            plan.append(pos)
+            excess_tokens -= self.history[pos]["tokens"] - SUMMARY_EXPECTED_TOKEN
+        return plan
 
-    @staticmethod
-    @alru_cache(maxsize=1024, typed=True)
-    async def get_summary(text: str) -> str:
-        chat = Chat()
-        chat.user = "summary by system"
-        model = chat.get_model()
-        print(f"Summarizing: {get_tokens(model, text)}")
-        summary = await chat.ask("Summarize the following:" + text)
-        print(
-            f"Summarized: {get_tokens(model, text)} -> {get_tokens(model, summary)}; {chat.last_completion.usage.total_tokens} tokens used."
+    async def get_summary(self, text: str, prompt: str = SUMMARY_PROMPT) -> str:
+        return await summary_cache.get_or_create(
+            self.get_model(),
+            prompt,
+            text,
+            lambda: summarize(self.openai, text, prompt),
         )
-        return summary
+
+
+async def summarize(
+    client: openai.AsyncOpenAI, text: str, prompt: str = SUMMARY_PROMPT
+) -> str:
+    # Uncached; callers go through `summary_cache`, see `Chat.get_summary`.
+    chat = Chat(client=client)
+    chat.user = "summary by system"
+    model = chat.get_model()
+    summary = await chat.ask(prompt + text, max_tokens=SUMMARY_MAX_TOKEN)
+    logger.debug(
+        f"Summarized: {get_tokens(model, text)} -> {get_tokens(model, summary)}; {chat.last_usage.total_tokens} tokens used."
+    )
+    return summary
+
+
+class QueueNotice:
+    """
+    Shows the queue position of a waiting request as a reply, and removes it
+    once the request is sent.
+    """
+
+    def __init__(self, context: commands.Context, edit_interval: float = 2.0):
+        self.context = context
+        self.edit_interval = edit_interval
+        self.message: Optional[discord.Message] = None
+        self.position = 0
+        self.shown = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def update(self, position: int):
+        self.position = position
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.sync())
+
+    async def sync(self):
+        # Only the latest position is shown; the ones in between are skipped.
+        while self.shown != self.position:
+            position = self.position
+            content = f":hourglass: Waiting in the queue, position {position}"
+            if not position:
+                await self.message.delete()
+                self.message = None
+            elif self.message is None:
+                self.message = await self.context.reply(content)
+            else:
+                await self.message.edit(content=content)
+                await asyncio.sleep(self.edit_interval)
+            self.shown = position
+
+    async def close(self):
+        self.update(0)
+        try:
+            await self.task
+        except discord.HTTPException:
+            pass
+
+
+class Generation:
+    """
+    The task answering a message, and what is known about its progress.
+    """
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.started_at = time.monotonic()
+        self.chat: Optional[Chat] = None
+
+
+class GenerationStats:
+    """
+    Counts the cancelled generations, and estimates the tokens and seconds they
+    would have used from the running averages of the finished ones.
+    """
+
+    def __init__(self, smoothing: float = 0.1):
+        self.smoothing = smoothing
+        self.finished = 0
+        self.cancelled = 0
+        self.average_seconds = 0.0
+        self.average_completion_tokens = 0.0
+        self.saved_tokens = 0
+        self.saved_seconds = 0.0
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Finished generations": self.finished,
+            "Cancelled generations": self.cancelled,
+            "Tokens saved by cancelling (estimated)": round(self.saved_tokens),
+            "Seconds saved by cancelling (estimated)": round(self.saved_seconds),
+        }
+
+    def add_finished(self, generation: Generation):
+        usage = generation.chat.last_usage if generation.chat else None
+        if usage is None:
+            # Errors and system messages tell nothing about a generation.
+            return
+
+        seconds = time.monotonic() - generation.started_at
+        tokens = usage.completion_tokens
+        if not self.finished:
+            self.average_seconds = seconds
+            self.average_completion_tokens = tokens
+        else:
+            self.average_seconds += (seconds - self.average_seconds) * self.smoothing
+            self.average_completion_tokens += (
+                tokens - self.average_completion_tokens
+            ) * self.smoothing
+        self.finished += 1
+
+    def add_cancelled(self, generation: Generation):
+        self.cancelled += 1
+        elapsed = time.monotonic() - generation.started_at
+        self.saved_seconds += max(self.average_seconds - elapsed, 0.0)
+
+        chat = generation.chat
+        if chat is None:
+            return
+        elif not chat.requested:
+            # The prompt was never sent.
+            self.saved_tokens += chat.get_tokens() + self.average_completion_tokens
+        else:
+            remaining = self.average_completion_tokens - chat.streamed_tokens
+            self.saved_tokens += max(remaining, 0.0)
 
 
 class ChatGPT(commands.Cog, name="chatgpt"):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.reply_ids: dict[int, set] = defaultdict(set)
-        self.interactions: dict[int, commands.Context] = {}
-        self.bot.config.setdefault("chatgpt_tokens_count", 0)  # noqa
+        self.reply_ids = ReplyIndex(
+            maxsize=self.bot.config.get("chatgpt_reply_index_size", 65536),  # noqa
+            ttl=self.bot.config.get("chatgpt_reply_index_ttl", 7 * 24 * 3600),  # noqa
+        )
+        # Interaction tokens expire after 15 minutes, so older contexts are useless.
+        self.interactions: LRUCache[int, commands.Context] = LRUCache(
+            maxsize=1024, ttl=15 * 60
+        )
+        size = self.bot.config.get("chatgpt_conversation_cache_size", 1024)  # noqa
+        self.conversations = ConversationStore(maxsize=size)
+        self.conversation_writer = ConversationWriter()
+        self.transcripts = TranscriptWriter.from_config(self.bot.config)  # noqa
+        # Created on first use; a strategy may keep state, like rolling summaries.
+        self.context_strategies: dict[str, ContextStrategy] = {}
+        # message id -> the generation answering it
+        self.generations: dict[int, Generation] = {}
+        self.generation_stats = GenerationStats()
+        REGISTRY.gauge(
+            "chatgpt_in_flight",
+            "Answers being generated",
+            callback=lambda: len(self.generations),
+        )
+        # Set after a request; the presence is published by `publish_presence`.
+        self.presence_dirty = False
+        self.presence_name: Optional[str] = None
+
+    async def cog_load(self):
+        interval = self.bot.config.get("chatgpt_conversation_flush_interval", 5)  # noqa
+        self.flush_conversations.change_interval(seconds=interval)
+        self.flush_conversations.start()
+        self.prune_conversations.start()
+        interval = self.bot.config.get("chatgpt_presence_interval", 15)  # noqa
+        self.publish_presence.change_interval(seconds=interval)
+        self.publish_presence.start()
+        interval = self.bot.config.get("chatgpt_quota_sync_interval", 60)  # noqa
+        self.sync_quotas.change_interval(seconds=interval)
+        self.sync_quotas.start()
+
+    async def cog_unload(self):
+        self.sync_quotas.cancel()
+        self.publish_presence.cancel()
+        self.prune_conversations.cancel()
+        self.flush_conversations.cancel()
+        await self.conversation_writer.flush()
+        await self.transcripts.flush()
+        await self.bot.usage.flush()  # noqa
+        # The pooled client is recreated lazily, so a reload gets a fresh pool.
+        await self.bot.openai.aclose()  # noqa
+
+    @tasks.loop(seconds=5)
+    async def flush_conversations(self):
+        try:
+            await self.conversation_writer.flush()
+            await self.transcripts.flush()
+            await self.bot.usage.flush()  # noqa
+        except Exception as e:
+            self.bot.logger.exception(e)  # noqa
+
+    @tasks.loop(seconds=15)
+    async def publish_presence(self):
+        if not self.presence_dirty:
+            return
+
+        self.presence_dirty = False
+        try:
+            await self.update_presence()
+        except Exception as e:
+            self.bot.logger.exception(e)  # noqa
+
+    @publish_presence.before_loop
+    async def before_publish_presence(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(seconds=60)
+    async def sync_quotas(self):
+        try:
+            await db_manager.replace_quota_usage(self.bot.quotas.get_rows())  # noqa
+        except Exception as e:
+            self.bot.logger.exception(e)  # noqa
+
+    @tasks.loop(hours=1)
+    async def prune_conversations(self):
+        ttl_days = self.bot.config.get("chatgpt_conversation_ttl_days", 30)  # noqa
+        try:
+            await db_manager.prune_conversations(ttl_days)
+        except Exception as e:
+            self.bot.logger.exception(e)  # noqa
 
     @commands.hybrid_command(
         name="chatgpt",
@@ -169,6 +723,7 @@ class ChatGPT(commands.Cog, name="chatgpt"):
         description="Talk to a ChatGPT model",
     )
     @commands.check(checks.not_blacklisted)
+    @commands.check(checks.within_quota)
     @app_commands.describe(
         question="The message to send to the model",
     )
@@ -180,77 +735,271 @@ class ChatGPT(commands.Cog, name="chatgpt"):
 
         self.assign_interaction(context, question)
 
+        # Tracked, so an edit or delete can cancel the answer to the old content.
+        generation = Generation(asyncio.current_task())
+        self.generations[context.message.id] = generation
         try:
-            chat = await self.build_chat(context, question)
+            with tracer.span("chatgpt", message_id=context.message.id):
+                with self.bot.profiler.request():  # noqa
+                    await self.answer(context, question, generation)
+        except asyncio.CancelledError:
+            self.generation_stats.add_cancelled(generation)
+            raise
+        else:
+            self.generation_stats.add_finished(generation)
+        finally:
+            if self.generations.get(context.message.id) is generation:
+                del self.generations[context.message.id]
+
+    async def answer(
+        self,
+        context: commands.Context,
+        question: Optional[str],
+        generation: Generation,
+    ):
+        # A reply with only an attachment, or a bare mention, has no question.
+        fresh = bool(question) and question.lower().startswith(FRESH_PREFIX)
+        if fresh:
+            question = question[len(FRESH_PREFIX) :].strip()
+
+        try:
+            chat = generation.chat = await self.build_chat(context, question)
+            history = [dict(item) for item in chat]
             if chat[-1]["role"] == "system":
-                await self.reply(context, "[SYSTEM] System message is set.")
+                answer = "[SYSTEM] System message is set."
+                reply = await self.reply(context, answer)
+                self.conversation_writer.add(
+                    reply.id, context.message.id, None, answer, 0
+                )
+                self.conversations.put(reply.id, history)
                 return
 
-            async with context.typing():
-                await self.preprocessing_chat(context, chat)
-                answer = await chat.ask()
-                await self.reply(context, answer)
-                chat.print(context.message)
+            response_key = cached = None
+            if self.bot.config.get("chatgpt_response_cache", False):  # noqa
+                response_key = self.get_response_key(chat)
+            # A fresh answer is still stored, replacing the cached one.
+            if response_key and not fresh:
+                cached = await response_cache.get(response_key)
+
+            if cached is not None:
+                chat.add_message("assistant", cached.response)
+                reply = await self.reply(context, cached.response)
+            else:
+                notice = QueueNotice(context)
+                chat.on_queue_position = notice.update
+                quotas: QuotaEngine = self.bot.quotas  # noqa
+                quota_ids = get_quota_ids(context)
+                async with context.typing():
+                    try:
+                        # Checked before the preprocessing, which may already
+                        # send summary requests to OpenAI; the prompt will be
+                        # shortened to at most max_prompt_tokens by then.
+                        quotas.check(
+                            quota_ids,
+                            min(chat.get_tokens(), self.get_max_prompt_tokens(chat)),
+                        )
+                        await self.preprocessing_chat(context, chat)
+                        reservation = quotas.reserve(quota_ids, chat.get_tokens())
+                        if self.bot.config.get("chatgpt_stream", False):  # noqa
+                            # Includes the edits of the streamed reply.
+                            with COMPLETION_SECONDS.time():
+                                reply = await self.reply_stream(context, chat)
+                        else:
+                            with COMPLETION_SECONDS.time():
+                                answer = await chat.ask()
+                            reply = await self.reply(context, answer)
+                    finally:
+                        await notice.close()
+
+                # The estimate is replaced by the real usage; a failed request keeps it.
+                if chat.last_usage is not None:
+                    quotas.settle(reservation, chat.last_usage.total_tokens)
+
+                if response_key and chat.last_usage is not None:
+                    await response_cache.put(
+                        response_key,
+                        CachedResponse(
+                            chat[-1]["content"],
+                            chat.last_model or chat.get_model(),
+                            chat.last_usage.prompt_tokens,
+                            chat.last_usage.completion_tokens,
+                        ),
+                    )
+
+            item = dict(chat[-1], message_id=reply.id)
+            self.conversation_writer.add(
+                reply.id,
+                context.message.id,
+                item["role"],
+                item["content"],
+                item["tokens"],
+            )
+            history.append(item)
+            self.conversations.put(reply.id, history)
+            self.transcripts.add(chat.get_transcript(context.message))
+        except QuotaExceeded:
+            # Replied to by `on_command_error`.
+            raise
         except Exception as e:
+            ERRORS.labels(type(e).__name__).inc()
             self.bot.logger.exception(e)  # noqa
             await self.reply(context, f":warning: **{type(e).__name__}**: {e}")
 
-        await self.update_presence()
+        # Published in the background, at most once per interval.
+        self.presence_dirty = True
 
-    async def preprocessing_chat(self, context: commands.Context, chat: Chat):
-        title = f"{context.author} @ {datetime.now().replace(microsecond=0)}"
-
-        before_tokens = chat.get_tokens()
-        print(f"{title}: Requesting {before_tokens} tokens")
+    @staticmethod
+    def get_response_key(chat: Chat) -> Optional[str]:
+        """
+        :return: The cache key of a single-turn chat, or None for a reply chain.
+        """
+        *system, question = chat
+        if question["role"] != "user" or any(
+            item["role"] != "system" for item in system
+        ):
+            return None
 
-        await chat.compress_large_messages(
-            threshold_tokens=COMPRESS_THRESHOLD_TOKEN,
-            max_prompt_tokens=MAX_PROMPT_TOKEN,
+        return get_response_key(
+            chat.get_model(),
+            [item["content"] for item in system],
+            question["content"],
         )
+
+    async def preprocessing_chat(self, context: commands.Context, chat: Chat):
+        before_tokens = chat.get_tokens()
+        max_prompt_tokens = self.get_max_prompt_tokens(chat)
+        with COMPRESS_SECONDS.time():
+            await chat.compress_large_messages(max_prompt_tokens=max_prompt_tokens)
+            strategy = self.get_context_strategy(context.guild)
+            await strategy.apply(chat, max_prompt_tokens)
         after_tokens = chat.get_tokens()
         discarded_tokens = before_tokens - after_tokens
         if discarded_tokens:
-            print(
-                f"{title}: Requesting {after_tokens} tokens; discarded {discarded_tokens} tokens"
+            self.bot.logger.debug(  # noqa
+                f"{context.author}: Requesting {after_tokens} tokens; discarded {discarded_tokens} tokens"
             )
 
+    def get_max_prompt_tokens(self, chat: Chat) -> int:
+        reserve = self.bot.config.get(  # noqa
+            "chatgpt_context_reserve_tokens", CONTEXT_RESERVE_TOKEN
+        )
+        return chat.get_max_prompt_tokens(reserve)
+
+    def get_context_strategy(self, guild: Optional[discord.Guild]) -> ContextStrategy:
+        name = self.bot.config.get("chatgpt_context_strategy", "truncate")  # noqa
+        if guild is not None:
+            strategies = self.bot.config.get("chatgpt_context_strategies", {})  # noqa
+            name = strategies.get(str(guild.id), name)
+
+        strategy = self.context_strategies.get(name)
+        if strategy is None:
+            strategy = create_context_strategy(name, self.bot.config)  # noqa
+            self.context_strategies[name] = strategy
+        return strategy
+
     async def update_presence(self):
-        chatgpt_tokens_count = self.bot.config["chatgpt_tokens_count"]  # noqa
-        await self.bot.change_presence(
-            activity=discord.Activity(
-                type=discord.ActivityType.playing,
-                name=(
-                    f"{chatgpt_tokens_count:,} tokens"
-                    f" = {chatgpt_tokens_count / 1000 * 0.002:,.2f} $"
-                ),
+        usage: UsageLedger = self.bot.usage  # noqa
+        name = f"{usage.total_tokens:,} tokens = {usage.total_cost:,.2f} $"
+        if self.bot.config.get("chatgpt_response_cache", False):  # noqa
+            name += (
+                f" ({response_cache.get_hit_rate():.0%} cached"
+                f", {response_cache.saved_cost:,.2f} $ saved)"
             )
+        # Presence updates are rate limited, so an unchanged one is not sent.
+        if name == self.presence_name:
+            return
+
+        await self.bot.change_presence(
+            activity=discord.Activity(type=discord.ActivityType.playing, name=name)
         )
+        self.presence_name = name
 
+    @tracer.traced("reply")
     async def reply(self, context: commands.Context, answer: str) -> discord.Message:
+        with REPLY_SECONDS.time():
+            if len(answer) >= 2000:
+                reply = await context.reply(file=self.get_answer_file(answer))
+            else:
+                reply = await context.reply(answer)
+
+        self.reply_ids.add(context.message.id, reply.id)
+        return reply
+
+    async def reply_stream(
+        self,
+        context: commands.Context,
+        chat: Chat,
+    ) -> discord.Message:
+        # Discord allows about 5 edits per 5 seconds in a channel.
+        edit_interval = self.bot.config.get("chatgpt_stream_edit_interval", 1.0)  # noqa
+        loop = asyncio.get_running_loop()
+
+        # The placeholder is posted while the completion request is in flight.
+        placeholder = asyncio.create_task(context.reply(STREAM_PLACEHOLDER))
+        reply = None
+        try:
+            answer = shown = ""
+            last_edit = loop.time()
+            async for delta in chat.ask_stream():
+                answer += delta
+                if len(answer) >= 2000:
+                    # Hand off to the attachment once the stream is finished.
+                    continue
+                elif shown and loop.time() - last_edit < edit_interval:
+                    continue
+                elif not answer.strip():
+                    continue
+
+                if reply is None:
+                    reply = await placeholder
+                    self.reply_ids.add(context.message.id, reply.id)
+
+                await reply.edit(content=answer)
+                shown = answer
+                last_edit = loop.time()
+
+            if reply is None:
+                reply = await placeholder
+                self.reply_ids.add(context.message.id, reply.id)
+        except BaseException:
+            if placeholder.cancel() or placeholder.cancelled():
+                raise
+            elif placeholder.exception() is None:
+                reply = placeholder.result()
+                self.reply_ids.discard(context.message.id, reply.id)
+                try:
+                    await reply.delete()
+                except discord.HTTPException:
+                    pass
+            raise
+
+        answer = chat[-1]["content"]
         if len(answer) >= 2000:
-            lines = []
-            for line in answer.splitlines():
-                while line:
-                    lines.append(line[:80])
-                    line = line[80:]
-
-            answer = "\n".join(lines)
-            answer_fp = io.BytesIO(answer.encode("utf-8"))
-            answer_file = discord.File(answer_fp, "message.txt")
-            reply = await context.reply(file=answer_file)
-        else:
-            reply = await context.reply(answer)
+            await reply.edit(content=None, attachments=[self.get_answer_file(answer)])
+        elif answer != shown:
+            await reply.edit(content=answer)
 
-        self.reply_ids[context.message.id].add(reply.id)
         return reply
 
+    @staticmethod
+    def get_answer_file(answer: str) -> discord.File:
+        lines = []
+        for line in answer.splitlines():
+            while line:
+                lines.append(line[:80])
+                line = line[80:]
+
+        answer = "\n".join(lines)
+        answer_fp = io.BytesIO(answer.encode("utf-8"))
+        return discord.File(answer_fp, "message.txt")
+
     def assign_interaction(self, context: commands.Context, question: str):
         if (
             getattr(context.message.type, "value", context.message.type)
             == discord.MessageType.chat_input_command
         ):
             context.message.content = question
-            self.interactions[context.message.id] = context
+            self.interactions.put(context.message.id, context)
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -262,29 +1011,77 @@ class ChatGPT(commands.Cog, name="chatgpt"):
         before_message: discord.Message,
         message: discord.Message,
     ):
-        if message.id in self.reply_ids:
-            reply_ids = self.reply_ids.pop(message.id, None)
-            if reply_ids:
-                await message.channel.delete_messages(
-                    [
-                        message.channel.get_partial_message(reply_id)
-                        for reply_id in reply_ids
-                    ]
-                )
+        if message.author != self.bot.user:
+            # The bot only edits its own replies while streaming them.
+            self.invalidate_message(message)
+            await self.cancel_generation(message.id)
+
+        reply_ids = await self.pop_reply_ids(message)
+        if reply_ids:
+            await message.channel.delete_messages(
+                [
+                    message.channel.get_partial_message(reply_id)
+                    for reply_id in reply_ids
+                ]
+            )
 
         await self.on_message(message)
 
     @commands.Cog.listener()
     async def on_message_delete(self, message: discord.Message):
-        if message.id in self.reply_ids:
-            reply_ids = self.reply_ids.pop(message.id, None)
-            if reply_ids:
-                await message.channel.delete_messages(
-                    [
-                        message.channel.get_partial_message(reply_id)
-                        for reply_id in reply_ids
-                    ]
-                )
+        self.invalidate_message(message)
+        await self.cancel_generation(message.id)
+        reply_ids = await self.pop_reply_ids(message)
+        if reply_ids:
+            await message.channel.delete_messages(
+                [
+                    message.channel.get_partial_message(reply_id)
+                    for reply_id in reply_ids
+                ]
+            )
+
+    async def cancel_generation(self, message_id: int, timeout: float = 5.0) -> bool:
+        generation = self.generations.pop(message_id, None)
+        if generation is None or generation.task is asyncio.current_task():
+            return False
+        elif not generation.task.cancel():
+            return False
+
+        # Waited for, so its partial reply is gone before the replies are deleted.
+        await asyncio.wait({generation.task}, timeout=timeout)
+        return True
+
+    async def pop_reply_ids(self, message: discord.Message) -> list[int]:
+        reply_ids = self.reply_ids.pop(message.id)
+        spill = self.bot.config.get("chatgpt_reply_index_spill", False)  # noqa
+        if not reply_ids and spill:
+            # Replies older than the in-memory index are looked up in the conversations.
+            reply_ids = await db_manager.get_reply_ids(message.id)
+        return reply_ids
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Reply index sources": len(self.reply_ids),
+            "Reply index pairs": self.reply_ids.get_pair_count(),
+            "Interactions": len(self.interactions),
+            "Cached conversations": len(self.conversations),
+            "Pending conversation writes": len(self.conversation_writer),
+            **self.transcripts.get_stats(),
+            **self.bot.usage.get_stats(),  # noqa
+            **self.bot.quotas.get_stats(),  # noqa
+            "Cached token counts": get_token_cache_size(),
+            **summary_cache.get_stats(),
+            **response_cache.get_stats(),
+            **self.bot.scheduler.get_stats(),  # noqa
+            **completion_coalescer.get_stats(),
+            **completion_engine.get_stats(),
+            **self.generation_stats.get_stats(),
+        }
+
+    def invalidate_message(self, message: discord.Message):
+        self.conversations.invalidate(message.id)
+        self.conversation_writer.remove(message.id)
+        self.fetch_message.cache_invalidate(message.channel, message.id)
 
     async def process_commands_for_mention_or_reply(self, message: discord.Message):
         # This is a modified version of commands.Bot.process_commands
@@ -324,14 +1121,18 @@ class ChatGPT(commands.Cog, name="chatgpt"):
         ctx.command = self.bot.get_command(invoker)
         return ctx
 
+    @tracer.traced("build_chat")
     async def build_chat(self, context: commands.Context, question: str) -> Chat:
         model = self.bot.config["openai_chatgpt_model"]  # noqa
 
         bot_member = context.guild.get_member(context.bot.user.id)
         bot_mention = f"@{bot_member.display_name}"
 
-        messages = []
-        for message in await self.fetch_all_messages(context.message, 64):
+        with FETCH_CHAIN_SECONDS.time():
+            history, messages = await self.fetch_all_messages(context.message, 64)
+        new_items = []
+        for message in messages:
+            parent_id = self.get_parent_id(message)
             role = "assistant" if message.author == self.bot.user else "user"
             if message == context.message:
                 text = question
@@ -339,50 +1140,114 @@ class ChatGPT(commands.Cog, name="chatgpt"):
                 text = cast(str, message.clean_content)
 
             text = removeprefix(text, bot_mention).strip()
+            if role == "user" and text.lower().startswith(FRESH_PREFIX):
+                text = text[len(FRESH_PREFIX) :].strip()
 
             if text.lower().startswith("[system]"):
                 if role == "user":
                     role = "system"
                     text = text[len("[system]") :].strip()
                 elif role == "assistant":
+                    self.conversation_writer.add(message.id, parent_id, None, text, 0)
                     continue
                 else:
                     raise ValueError("Unknown role")
 
             if message.attachments:
-                text += "\n\n" + (await self.fetch_attachment(message))
-                if get_tokens(model, text) > 1024 * 3:
-                    raise ValueError("Attachment too large")
+                with FETCH_ATTACHMENT_SECONDS.time():
+                    text += "\n\n" + (await self.fetch_attachment(message))
+
+            item = {
+                "role": role,
+                "content": text,
+                "tokens": None,
+                "message_id": message.id,
+            }
+            new_items.append((message, item))
 
             if role == "system":
-                messages.insert(0, {"role": role, "content": text})
+                history.insert(0, item)
             else:
-                messages.append({"role": role, "content": text})
+                history.append(item)
+
+        # The new messages are tokenized in one batch, off the event loop if large.
+        texts = [item["content"] for message, item in new_items]
+        with TOKENIZE_SECONDS.time():
+            token_counts = await aget_tokens_batch(model, texts)
+        for (message, item), tokens in zip(new_items, token_counts):
+            if message.attachments and tokens > 1024 * 3:
+                raise ValueError("Attachment too large")
 
-        return Chat(messages, context)
+            item["tokens"] = tokens
+            self.conversation_writer.add(
+                message.id,
+                self.get_parent_id(message),
+                item["role"],
+                item["content"],
+                tokens,
+            )
 
+        return Chat(history, context)
+
+    @tracer.traced("fetch_all_messages")
     async def fetch_all_messages(
         self,
         message: discord.Message,
         limit: int,
-    ) -> List[discord.Message]:
+    ) -> tuple[list[dict], List[discord.Message]]:
+        """
+        Walk the reply chain up from the message until the limit is reached, or
+        until a message whose conversation is already built is found.
+
+        :return: The history of the cached conversation (may be empty),
+            and the messages after it, oldest first.
+        """
+        history = []
         messages = []
         for i in range(limit):
             messages.append(message)
-            if message.reference:
+            parent_id = self.get_parent_id(message)
+            if parent_id is None:
+                break
+
+            cached_history = self.conversations.get(parent_id, limit - len(messages))
+            if cached_history is None and i == 0:
+                # Only the direct parent is looked up; a chain is stored as a whole.
+                cached_history = await self.load_conversation(
+                    parent_id, limit - len(messages)
+                )
+
+            if cached_history is not None:
+                history = cached_history
+                break
+            elif message.reference:
                 message = await self.fetch_reference_message(message)
-            elif message.interaction:
-                interaction = self.interactions.get(message.interaction.id)
+            else:
+                interaction = self.interactions.get(parent_id)
                 if interaction is None:
                     break
 
                 message = interaction.message  # noqa
-            else:
-                break
 
-        return messages[::-1]
+        return history, messages[::-1]
+
+    async def load_conversation(
+        self, message_id: int, limit: int
+    ) -> Optional[list[dict]]:
+        history = await load_history(message_id, limit)
+        if history is not None:
+            self.conversations.put(message_id, history)
+        return history
+
+    @staticmethod
+    def get_parent_id(message: discord.Message) -> Optional[int]:
+        if message.reference:
+            return message.reference.message_id
+        elif message.interaction:
+            return message.interaction.id
+        else:
+            return None
 
-    @alru_cache(maxsize=256, typed=True, ttl=3600)
     async def fetch_reference_message(
         self, message: discord.Message
     ) -> Optional[discord.Message]:
@@ -390,9 +1255,16 @@ class ChatGPT(commands.Cog, name="chatgpt"):
         if reference.cached_message:
             return reference.cached_message
         else:
-            return await message.channel.fetch_message(reference.message_id)
+            return await self.fetch_message(message.channel, reference.message_id)
+
+    @alru_cache(maxsize=256, typed=True, ttl=3600)
+    async def fetch_message(
+        self, channel: discord.abc.Messageable, message_id: int
+    ) -> discord.Message:
+        return await channel.fetch_message(message_id)
 
     @alru_cache(maxsize=64, typed=True, ttl=3600)
+    @tracer.traced("fetch_attachment")
     async def fetch_attachment(self, message: discord.Message) -> str:
         if len(message.attachments) > 1:
             raise ValueError("Too many attachments")
@@ -5,6 +5,8 @@ Description:
 
 Version: 5.5.0
 """
+import asyncio
+import io
 from typing import Optional
 
 import discord
@@ -199,6 +201,165 @@ class Owner(commands.Cog, name="owner"):
         await context.send(embed=embed)
         await self.bot.close()
 
+    @commands.hybrid_command(
+        name="stats",
+        description="Shows the internal statistics of the loaded cogs.",
+    )
+    @app_commands.guilds(OWNER_GUILD_ID)
+    @commands.check(checks.is_owner)
+    async def stats(self, context: Context) -> None:
+        """
+        Shows the internal statistics (cache sizes, counters...) of the loaded cogs.
+
+        :param context: The hybrid command context.
+        """
+        embed = discord.Embed(title="Statistics", color=0x9C84EF)
+        report = []
+        for name, cog in self.bot.cogs.items():
+            get_stats = getattr(cog, "get_stats", None)
+            if get_stats is None:
+                continue
+
+            lines = [f"{key}: {value:,}" for key, value in get_stats().items()]
+            report.extend([f"[{name.capitalize()}]", *lines, ""])
+            # A field value holds at most 1024 characters, with the code block.
+            for pos, chunk in enumerate(join_lines(lines, 1024 - 6)):
+                embed.add_field(
+                    name=name.capitalize() if not pos else "\u200b",
+                    value=f"```{chunk}```",
+                    inline=False,
+                )
+
+        if len(embed) <= 6000 and len(embed.fields) <= 25:
+            await context.send(embed=embed)
+        else:
+            # Too much for an embed, so it is sent as a file instead.
+            report_fp = io.BytesIO("\n".join(report).encode("utf-8"))
+            await context.send(file=discord.File(report_fp, "stats.txt"))
+
+    @commands.hybrid_command(
+        name="profile",
+        description="Profiles the next requests and sends the report.",
+    )
+    @app_commands.guilds(OWNER_GUILD_ID)
+    @app_commands.describe(requests="How many requests should be profiled")
+    @commands.check(checks.is_owner)
+    async def profile(self, context: Context, requests: int = 10) -> None:
+        """
+        Profiles the next requests with cProfile and sends the report as a file.
+
+        :param context: The hybrid command context.
+        :param requests: How many requests should be profiled.
+        """
+        if self.bot.profiler.running:
+            embed = discord.Embed(
+                description="A profile is already running.", color=0xE02B2B
+            )
+            await context.send(embed=embed)
+            return
+
+        report = self.bot.profiler.start(requests)
+        embed = discord.Embed(
+            description=f"Profiling the next {requests} requests...", color=0x9C84EF
+        )
+        await context.send(embed=embed)
+        try:
+            # The interaction of a slash command expires after 15 minutes.
+            report = await asyncio.wait_for(report, timeout=14 * 60)
+        except asyncio.TimeoutError:
+            self.bot.profiler.cancel()
+            embed = discord.Embed(
+                description=f"Less than {requests} requests were made in 14 minutes; the profile was cancelled.",
+                color=0xE02B2B,
+            )
+            await context.send(embed=embed)
+            return
+
+        report_fp = io.BytesIO(report.encode("utf-8"))
+        await context.send(file=discord.File(report_fp, "profile.txt"))
+
+    @commands.hybrid_group(
+        name="usage",
+        description="Shows the token usage and its cost.",
+    )
+    @app_commands.guilds(OWNER_GUILD_ID)
+    @commands.check(checks.is_owner)
+    async def usage(self, context: Context) -> None:
+        """
+        Shows the token usage and its cost.
+
+        :param context: The hybrid command context.
+        """
+        if context.invoked_subcommand is None:
+            embed = discord.Embed(
+                description="You need to specify a subcommand.\n\n**Subcommands:**\n`top` - Shows the users who spent the most.\n`daily` - Shows the usage of each day.",
+                color=0xE02B2B,
+            )
+            await context.send(embed=embed)
+
+    @usage.command(
+        base="usage",
+        name="top",
+        description="Shows the users who spent the most over the last days.",
+    )
+    @app_commands.guilds(OWNER_GUILD_ID)
+    @app_commands.describe(days="How many days are counted, including today")
+    @commands.check(checks.is_owner)
+    async def usage_top(self, context: Context, days: int = 30) -> None:
+        """
+        Shows the users who spent the most over the last days.
+
+        :param context: The hybrid command context.
+        :param days: How many days are counted, including today.
+        """
+        # The pending usage is written first, so the answer is up to date.
+        await self.bot.usage.flush()
+        top_users = await db_manager.get_top_users(days, 10)
+        if len(top_users) == 0:
+            embed = discord.Embed(
+                description=f"There is no usage in the last {days} days.",
+                color=0xE02B2B,
+            )
+            await context.send(embed=embed)
+            return
+
+        embed = discord.Embed(title=f"Top Users ({days} days)", color=0x9C84EF)
+        embed.description = "\n".join(
+            f"• <@{user_id}> - {requests:,} requests, {tokens:,} tokens = {cost:,.2f} $"
+            for user_id, requests, tokens, cost in top_users
+        )
+        await context.send(embed=embed)
+
+    @usage.command(
+        base="usage",
+        name="daily",
+        description="Shows the usage of each of the last days.",
+    )
+    @app_commands.guilds(OWNER_GUILD_ID)
+    @app_commands.describe(days="How many days are shown, including today")
+    @commands.check(checks.is_owner)
+    async def usage_daily(self, context: Context, days: int = 7) -> None:
+        """
+        Shows the usage of each of the last days.
+
+        :param context: The hybrid command context.
+        :param days: How many days are shown, including today.
+        """
+        await self.bot.usage.flush()
+        daily_usage = await db_manager.get_daily_usage(days)
+        embed = discord.Embed(title=f"Daily Usage ({days} days)", color=0x9C84EF)
+        embed.description = (
+            "\n".join(
+                f"• {day} - {requests:,} requests, {tokens:,} tokens = {cost:,.2f} $"
+                for day, requests, tokens, cost in daily_usage
+            )
+            or "There is no usage."
+        )
+        embed.set_footer(
+            text=f"All time: {self.bot.usage.total_tokens:,} tokens = {self.bot.usage.total_cost:,.2f} $"
+        )
+        await context.send(embed=embed)
+
     @commands.hybrid_command(
         name="say",
         description="The bot will say anything you want.",
@@ -348,5 +509,22 @@ class Owner(commands.Cog, name="owner"):
         await context.send(embed=embed)
 
 
+def join_lines(lines: list[str], max_length: int) -> list[str]:
+    """
+    Join the lines into as few chunks of at most max_length characters as possible.
+    """
+    chunks = []
+    chunk = ""
+    for line in lines:
+        line = line[:max_length]
+        if chunk and len(chunk) + 1 + len(line) > max_length:
+            chunks.append(chunk)
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
 async def setup(bot):
     await bot.add_cog(Owner(bot))
@@ -3,6 +3,8 @@ CREATE TABLE IF NOT EXISTS `blacklist` (
   `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS `blacklist_user_id` ON `blacklist` (`user_id`);
+
 CREATE TABLE IF NOT EXISTS `warns` (
   `id` int(11) NOT NULL,
   `user_id` varchar(20) NOT NULL,
@@ -11,3 +13,58 @@ CREATE TABLE IF NOT EXISTS `warns` (
   `reason` varchar(255) NOT NULL,
   `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
+
+CREATE TABLE IF NOT EXISTS `conversations` (
+  `message_id` INTEGER PRIMARY KEY,
+  `parent_id` INTEGER,
+  `role` varchar(20),
+  `content` text NOT NULL,
+  `tokens` int(11) NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS `conversations_parent_id` ON `conversations` (`parent_id`);
+
+CREATE TABLE IF NOT EXISTS `summaries` (
+  `key` char(64) PRIMARY KEY,
+  `model` varchar(64) NOT NULL,
+  `summary` text NOT NULL,
+  `size` int(11) NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `used_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS `summaries_used_at` ON `summaries` (`used_at`);
+
+CREATE TABLE IF NOT EXISTS `responses` (
+  `key` char(64) PRIMARY KEY,
+  `response` text NOT NULL,
+  `model` varchar(64) NOT NULL,
+  `prompt_tokens` int(11) NOT NULL,
+  `completion_tokens` int(11) NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `used_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS `responses_used_at` ON `responses` (`used_at`);
+
+CREATE TABLE IF NOT EXISTS `usage` (
+  `day` date NOT NULL,
+  `guild_id` INTEGER NOT NULL,
+  `user_id` INTEGER NOT NULL,
+  `model` varchar(64) NOT NULL,
+  `requests` int(11) NOT NULL,
+  `prompt_tokens` int(11) NOT NULL,
+  `completion_tokens` int(11) NOT NULL,
+  `cost` real NOT NULL,
+  PRIMARY KEY (`day`, `guild_id`, `user_id`, `model`)
+);
+
+CREATE TABLE IF NOT EXISTS `quota_usage` (
+  `scope` varchar(20) NOT NULL,
+  `id` INTEGER NOT NULL,
+  `window` real NOT NULL,
+  `start` real NOT NULL,
+  `requests` int(11) NOT NULL,
+  `tokens` int(11) NOT NULL
+);
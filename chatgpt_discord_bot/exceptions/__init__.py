@@ -27,3 +27,15 @@ class UserNotOwner(commands.CheckFailure):
     def __init__(self, message="User is not an owner of the bot!"):
         self.message = message
         super().__init__(self.message)
+
+
+class QuotaExceeded(commands.CheckFailure):
+    """
+    Thrown when a user is attempting something, but the user, the guild or the channel has used up its quota.
+    """
+
+    def __init__(self, scope: str, retry_after: float, message=None):
+        self.scope = scope
+        self.retry_after = retry_after
+        self.message = message or f"The {scope} quota is exceeded!"
+        super().__init__(self.message)
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import time
+from array import array
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Iterator, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class LRUCache(Generic[K, V]):
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: Optional[float] = None,
+        on_evict: Optional[Callable[[K, V], None]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key: K, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+
+        created_at, value = entry
+        if self.ttl is not None and time.monotonic() - created_at > self.ttl:
+            self.pop(key)
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V):
+        self.pop(key)
+        self._data[key] = (time.monotonic(), value)
+        while len(self._data) > self.maxsize:
+            old_key, (_, old_value) = self._data.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key: K, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+
+        _, value = entry
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+        return value
+
+    def clear(self):
+        while self._data:
+            self.pop(next(iter(self._data)))
+
+
+class ReplyIndex:
+    """
+    A bounded map of source message ID -> reply message IDs.
+
+    Pairs are kept in fixed-size int64 ring buffers instead of a dict of sets;
+    the oldest pairs are dropped once the buffer is full or their age exceeds the ttl.
+    """
+
+    def __init__(self, maxsize: int = 65536, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._sources = array("q", bytes(8 * maxsize))
+        self._replies = array("q", bytes(8 * maxsize))  # 0 marks a removed pair
+        self._previous = array("q", bytes(8 * maxsize))  # previous pair of the source
+        self._times = array("d", bytes(8 * maxsize))
+        # source message id -> position of its latest pair
+        self._index: dict[int, int] = {}
+        # positions only grow; a pair is alive while its position is in [tail, head)
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, source_id: int) -> bool:
+        return bool(self.get(source_id))
+
+    def get_pair_count(self) -> int:
+        return self._head - self._tail
+
+    def add(self, source_id: int, reply_id: int):
+        self.expire()
+        if self._head - self._tail >= self.maxsize:
+            self._drop_oldest()
+
+        position = self._head
+        slot = position % self.maxsize
+        self._sources[slot] = source_id
+        self._replies[slot] = reply_id
+        self._previous[slot] = self._index.get(source_id, -1)
+        self._times[slot] = time.monotonic()
+        self._index[source_id] = position
+        self._head += 1
+
+    def get(self, source_id: int) -> list[int]:
+        self.expire()
+        return [self._replies[slot] for slot in self._iter_slots(source_id)]
+
+    def pop(self, source_id: int) -> list[int]:
+        reply_ids = self.get(source_id)
+        for slot in tuple(self._iter_slots(source_id)):
+            self._replies[slot] = 0
+        self._index.pop(source_id, None)
+        return reply_ids
+
+    def discard(self, source_id: int, reply_id: int):
+        for slot in tuple(self._iter_slots(source_id)):
+            if self._replies[slot] == reply_id:
+                self._replies[slot] = 0
+
+    def expire(self):
+        if self.ttl is None:
+            return
+
+        deadline = time.monotonic() - self.ttl
+        while self._tail < self._head:
+            if self._times[self._tail % self.maxsize] > deadline:
+                break
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        position = self._tail
+        source_id = self._sources[position % self.maxsize]
+        if self._index.get(source_id) == position:
+            del self._index[source_id]
+        self._tail += 1
+
+    def _iter_slots(self, source_id: int) -> Iterator[int]:
+        position = self._index.get(source_id, -1)
+        while position >= self._tail:
+            slot = position % self.maxsize
+            if self._replies[slot]:
+                yield slot
+            position = self._previous[slot]
@@ -12,6 +12,7 @@ from discord.ext import commands
 
 from chatgpt_discord_bot.exceptions import UserBlacklisted, UserNotOwner
 from chatgpt_discord_bot.helpers import db_manager
+from chatgpt_discord_bot.helpers.quotas import get_quota_ids
 
 T = TypeVar("T")
 
@@ -32,3 +33,11 @@ async def not_blacklisted(context: commands.Context) -> bool:
     if await db_manager.is_blacklisted(context.author.id):
         raise UserBlacklisted
     return True
+
+
+async def within_quota(context: commands.Context) -> bool:
+    """
+    This is a custom check to see if the user, guild and channel executing the command are within their quotas.
+    """
+    context.bot.quotas.check(get_quota_ids(context))
+    return True
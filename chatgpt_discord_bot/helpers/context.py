@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+from hashlib import blake2b
+from typing import Optional, Protocol
+
+from chatgpt_discord_bot.helpers.cache import LRUCache
+
+ROLLING_SUMMARY_PROMPT = (
+    "Summarize the following conversation, keeping the facts, names and decisions"
+    " needed to continue it:"
+)
+ROLLING_SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+class ChatLike(Protocol):
+    history: list[dict]
+
+    def get_tokens(self) -> int: ...
+
+    def insert_message(self, index: int, role: str, content: str): ...
+
+    def remove_message(self, index: int) -> dict: ...
+
+    async def get_summary(self, text: str, prompt: str = ...) -> str: ...
+
+
+class ContextStrategy:
+    """
+    Decides which part of a long chat is sent to the model.
+
+    `apply` edits the chat in place so its prompt fits in max_prompt_tokens;
+    the stored conversation is left untouched.
+    """
+
+    name = "none"
+
+    async def apply(self, chat: ChatLike, max_prompt_tokens: int):
+        pass
+
+
+class TruncateStrategy(ContextStrategy):
+    """
+    Drop the oldest messages until the prompt fits; system messages and the
+    last message are always kept.
+    """
+
+    name = "truncate"
+
+    async def apply(self, chat: ChatLike, max_prompt_tokens: int):
+        pos = 0
+        while chat.get_tokens() > max_prompt_tokens and pos < len(chat.history) - 1:
+            if chat.history[pos]["role"] == "system":
+                pos += 1
+            else:
+                chat.remove_message(pos)
+
+
+class LastKStrategy(TruncateStrategy):
+    """
+    Keep the system messages and the last K messages, then truncate if the
+    prompt is still too large.
+    """
+
+    name = "last_k"
+
+    def __init__(self, k: int = 20):
+        # With no message kept, the question itself would be dropped.
+        if k < 1:
+            raise ValueError(f"The last K messages must be at least 1, not {k}")
+        self.k = k
+
+    async def apply(self, chat: ChatLike, max_prompt_tokens: int):
+        positions = [
+            pos for pos, item in enumerate(chat.history) if item["role"] != "system"
+        ]
+        for pos in reversed(positions[: -self.k]):
+            chat.remove_message(pos)
+        await super().apply(chat, max_prompt_tokens)
+
+
+class RollingSummaryStrategy(TruncateStrategy):
+    """
+    Replace the older messages with a summary, and keep as many of the newest
+    messages as fit next to it.
+
+    The summary is folded in chunks; the summary after each chunk is kept, so a
+    growing chain only summarizes the messages added since the last one.
+    """
+
+    name = "rolling_summary"
+
+    def __init__(
+        self,
+        summary_tokens: int = 512,
+        chunk_tokens: int = 2048,
+        cache_size: int = 1024,
+    ):
+        self.summary_tokens = summary_tokens
+        self.chunk_tokens = chunk_tokens
+        # digest of the messages so far -> summary of those messages
+        self.summaries: LRUCache[bytes, str] = LRUCache(maxsize=cache_size)
+
+    async def apply(self, chat: ChatLike, max_prompt_tokens: int):
+        if chat.get_tokens() <= max_prompt_tokens:
+            return
+
+        history = chat.history
+        positions = [
+            pos for pos, item in enumerate(history) if item["role"] != "system"
+        ]
+        budget = chat.get_tokens() - max_prompt_tokens + self.summary_tokens
+        # Fold the oldest messages until the rest fits next to the summary.
+        split = 0
+        while split < len(positions) - 1 and budget > 0:
+            budget -= history[positions[split]]["tokens"]
+            split += 1
+
+        older = [history[pos] for pos in positions[:split]]
+        summary = await self.get_summary(chat, older) if older else None
+        for pos in reversed(positions[:split]):
+            chat.remove_message(pos)
+
+        if summary:
+            index = len(history) - (len(positions) - split)
+            chat.insert_message(index, "system", ROLLING_SUMMARY_PREFIX + summary)
+
+        # The summary may be longer than expected.
+        await super().apply(chat, max_prompt_tokens)
+
+    async def get_summary(self, chat: ChatLike, items: list[dict]) -> Optional[str]:
+        keys = self.get_prefix_keys(items)
+        # Start from the longest prefix which was already summarized.
+        summary = None
+        start = 0
+        for pos in range(len(items) - 1, -1, -1):
+            cached = self.summaries.get(keys[pos])
+            if cached is not None:
+                summary, start = cached, pos + 1
+                break
+
+        chunk: list[dict] = []
+        chunk_tokens = 0
+        for pos in range(start, len(items)):
+            chunk.append(items[pos])
+            chunk_tokens += items[pos]["tokens"]
+            if chunk_tokens >= self.chunk_tokens or pos == len(items) - 1:
+                summary = await chat.get_summary(
+                    self.format_chunk(summary, chunk), prompt=ROLLING_SUMMARY_PROMPT
+                )
+                self.summaries.put(keys[pos], summary)
+                chunk, chunk_tokens = [], 0
+        return summary
+
+    @staticmethod
+    def get_prefix_keys(items: list[dict]) -> list[bytes]:
+        # The key of a position covers every message up to it, so an edited
+        # message never reuses a stale summary.
+        digest = blake2b(digest_size=16)
+        keys = []
+        for item in items:
+            digest.update(f"{item['role']}\0{item['content']}\0".encode("utf-8"))
+            keys.append(digest.copy().digest())
+        return keys
+
+    @staticmethod
+    def format_chunk(summary: Optional[str], items: list[dict]) -> str:
+        lines = []
+        if summary:
+            lines.append(f"(summary so far) {summary}")
+        lines.extend(f"{item['role']}: {item['content']}" for item in items)
+        return "\n".join(lines)
+
+
+def create_context_strategy(name: str, config: dict) -> ContextStrategy:
+    if name == TruncateStrategy.name:
+        return TruncateStrategy()
+    elif name == LastKStrategy.name:
+        return LastKStrategy(k=config.get("chatgpt_context_last_k", 20))
+    elif name == RollingSummaryStrategy.name:
+        return RollingSummaryStrategy(
+            chunk_tokens=config.get("chatgpt_context_summary_chunk_tokens", 2048),
+        )
+    elif name == ContextStrategy.name:
+        return ContextStrategy()
+    else:
+        raise ValueError(f"Unknown context strategy: {name}")
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Optional, Sequence
+
+from chatgpt_discord_bot.helpers import db_manager
+from chatgpt_discord_bot.helpers.cache import LRUCache
+
+
+class ConversationStore:
+    """
+    Maps a message ID to the already-built history (role, content, tokens) of
+    the chain ending at that message, so a follow-up reply only needs to build
+    the new message instead of walking the whole reply chain again.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self._cache: LRUCache[int, tuple[dict, ...]] = LRUCache(
+            maxsize=maxsize,
+            ttl=ttl,
+            on_evict=self._on_evict,
+        )
+        # message id -> ids of the chains which contain that message
+        self._chains: dict[int, set[int]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, message_id: int, limit: Optional[int] = None) -> Optional[list[dict]]:
+        history = self._cache.get(message_id)
+        if history is None:
+            return None
+
+        if limit is not None:
+            history = trim_history(history, limit)
+
+        return [dict(item) for item in history]
+
+    def put(self, message_id: int, history: list[dict]):
+        history = tuple(dict(item) for item in history)
+        self._cache.put(message_id, history)
+        self._chains[message_id].add(message_id)
+        for item in history:
+            if item.get("message_id") is not None:
+                self._chains[item["message_id"]].add(message_id)
+
+    def invalidate(self, message_id: int):
+        for chain_id in tuple(self._chains.get(message_id, ())):
+            self._cache.pop(chain_id)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _on_evict(self, chain_id: int, history: tuple[dict, ...]):
+        message_ids = {chain_id}
+        message_ids.update(item.get("message_id") for item in history)
+        for message_id in message_ids:
+            chains = self._chains.get(message_id)
+            if chains is None:
+                continue
+
+            chains.discard(chain_id)
+            if not chains:
+                del self._chains[message_id]
+
+
+def trim_history(history: Sequence[dict], limit: int) -> Sequence[dict]:
+    """
+    Keep the newest messages up to the limit; system messages stay in front.
+    """
+    if len(history) <= limit:
+        return history
+
+    system_items = [item for item in history if item["role"] == "system"]
+    other_items = [item for item in history if item["role"] != "system"]
+    keep = max(limit - len(system_items), 0)
+    return system_items + other_items[len(other_items) - keep :]
+
+
+class ConversationWriter:
+    """
+    Buffers conversation messages and writes them to the database in batches,
+    so the command path never waits on SQLite.
+    """
+
+    def __init__(self):
+        self._added: dict[int, tuple] = {}
+        self._removed: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._added) + len(self._removed)
+
+    def add(
+        self,
+        message_id: int,
+        parent_id: Optional[int],
+        role: Optional[str],
+        content: str,
+        tokens: int,
+    ):
+        self._removed.discard(message_id)
+        self._added[message_id] = (message_id, parent_id, role, content, tokens)
+
+    def remove(self, message_id: int):
+        self._added.pop(message_id, None)
+        self._removed.add(message_id)
+
+    async def flush(self):
+        added, self._added = self._added, {}
+        removed, self._removed = self._removed, set()
+        try:
+            if removed:
+                await db_manager.remove_conversation_messages(list(removed))
+                removed = set()
+            if added:
+                await db_manager.add_conversation_messages(list(added.values()))
+        except BaseException:
+            # Kept for the next flush instead of being lost; the messages added
+            # or removed since then are newer, so they win.
+            for message_id in removed:
+                if message_id not in self._added:
+                    self._removed.add(message_id)
+            for message_id, row in added.items():
+                if message_id not in self._added and message_id not in self._removed:
+                    self._added[message_id] = row
+            raise
+
+
+async def load_history(message_id: int, limit: int) -> Optional[list[dict]]:
+    """
+    Rebuild the history of the chain ending at the message from the database.
+
+    :return: The history, or None if the chain is not fully stored.
+    """
+    rows = await db_manager.get_conversation(message_id, limit)
+    if not rows or (rows[0][1] is not None and len(rows) < limit):
+        return None
+
+    history = []
+    for message_id, parent_id, role, content, tokens in rows:
+        if role is None:
+            continue
+
+        item = {
+            "role": role,
+            "content": content,
+            "tokens": tokens,
+            "message_id": message_id,
+        }
+
+        if role == "system":
+            history.insert(0, item)
+        else:
+            history.append(item)
+
+    return history
@@ -6,7 +6,9 @@ Description:
 Version: 5.5.0
 """
 
+import asyncio
 import os
+from typing import Optional
 
 import aiosqlite
 from pathlib import Path
@@ -15,6 +17,96 @@ package_dir = Path(__file__).parents[1]
 repo_dir = package_dir.parent
 
 DATABASE_PATH = repo_dir / "database.db"
+SCHEMA_PATH = package_dir / "database" / "schema.sql"
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+    "cache_size": -16000,  # in KiB
+}
+
+# Applied in order to existing databases; `PRAGMA user_version` is the number applied so far.
+MIGRATIONS = [
+    # 1: Remove duplicated users before `blacklist_user_id` becomes a unique index.
+    "DELETE FROM blacklist WHERE rowid NOT IN (SELECT MIN(rowid) FROM blacklist GROUP BY user_id);",
+]
+
+_connection: Optional[aiosqlite.Connection] = None
+_connection_lock = asyncio.Lock()
+
+# The blacklist is tiny and only changes through this module, so it is kept in memory.
+_blacklisted_user_ids: set[int] = set()
+
+
+async def get_connection() -> aiosqlite.Connection:
+    """
+    This function will return the shared database connection, opening it on first use.
+
+    :return: The long-lived connection used by every query of the bot.
+    """
+    global _connection
+    if _connection is not None:
+        return _connection
+
+    async with _connection_lock:
+        if _connection is None:
+            connection = await aiosqlite.connect(DATABASE_PATH, cached_statements=256)
+            for name, value in PRAGMAS.items():
+                await connection.execute(f"PRAGMA {name}={value}")
+            _connection = connection
+    return _connection
+
+
+async def init_db() -> None:
+    """
+    This function will open the shared connection, migrate and create the tables.
+    """
+    db = await get_connection()
+    await migrate(db)
+    with open(SCHEMA_PATH) as file:
+        await db.executescript(file.read())
+    await db.commit()
+    await load_blacklist()
+
+
+async def migrate(db: aiosqlite.Connection) -> None:
+    """
+    This function will apply the migrations that the database has not seen yet.
+
+    :param db: The database connection.
+    """
+    async with db.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+
+    async with db.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='blacklist'"
+    ) as cursor:
+        (is_existing,) = await cursor.fetchone()
+
+    if is_existing:
+        for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            await db.executescript(migration)
+            await db.execute(f"PRAGMA user_version={version}")
+    else:
+        # A new database is created from the up-to-date schema.
+        await db.execute(f"PRAGMA user_version={len(MIGRATIONS)}")
+    await db.commit()
+
+
+async def close() -> None:
+    """
+    This function will close the shared connection, if it is open.
+    """
+    global _connection
+    async with _connection_lock:
+        connection, _connection = _connection, None
+        if connection is not None:
+            try:
+                await connection.execute("PRAGMA optimize")
+            finally:
+                await connection.close()
 
 
 async def get_blacklisted_users() -> list:
@@ -24,12 +116,23 @@ async def get_blacklisted_users() -> list:
     :param user_id: The ID of the user that should be checked.
     :return: True if the user is blacklisted, False if not.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(
-            "SELECT user_id, strftime('%s', created_at) FROM blacklist"
-        ) as cursor:
-            result = await cursor.fetchall()
-            return result
+    db = await get_connection()
+    async with db.execute(
+        "SELECT user_id, strftime('%s', created_at) FROM blacklist"
+    ) as cursor:
+        result = await cursor.fetchall()
+        return result
+
+
+async def load_blacklist() -> None:
+    """
+    This function will load the blacklisted users into memory.
+    """
+    db = await get_connection()
+    async with db.execute("SELECT user_id FROM blacklist") as cursor:
+        result = await cursor.fetchall()
+    _blacklisted_user_ids.clear()
+    _blacklisted_user_ids.update(int(row[0]) for row in result)
 
 
 async def is_blacklisted(user_id: int) -> bool:
@@ -39,12 +142,7 @@ async def is_blacklisted(user_id: int) -> bool:
     :param user_id: The ID of the user that should be checked.
     :return: True if the user is blacklisted, False if not.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(
-            "SELECT * FROM blacklist WHERE user_id=?", (user_id,)
-        ) as cursor:
-            result = await cursor.fetchone()
-            return result is not None
+    return user_id in _blacklisted_user_ids
 
 
 async def add_user_to_blacklist(user_id: int) -> int:
@@ -53,13 +151,13 @@ async def add_user_to_blacklist(user_id: int) -> int:
 
     :param user_id: The ID of the user that should be added into the blacklist.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("INSERT INTO blacklist(user_id) VALUES (?)", (user_id,))
-        await db.commit()
-        rows = await db.execute("SELECT COUNT(*) FROM blacklist")
-        async with rows as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result is not None else 0
+    db = await get_connection()
+    await db.execute(
+        "INSERT OR IGNORE INTO blacklist(user_id) VALUES (?)", (str(user_id),)
+    )
+    await db.commit()
+    _blacklisted_user_ids.add(user_id)
+    return len(_blacklisted_user_ids)
 
 
 async def remove_user_from_blacklist(user_id: int) -> int:
@@ -68,13 +166,11 @@ async def remove_user_from_blacklist(user_id: int) -> int:
 
     :param user_id: The ID of the user that should be removed from the blacklist.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("DELETE FROM blacklist WHERE user_id=?", (user_id,))
-        await db.commit()
-        rows = await db.execute("SELECT COUNT(*) FROM blacklist")
-        async with rows as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result is not None else 0
+    db = await get_connection()
+    await db.execute("DELETE FROM blacklist WHERE user_id=?", (str(user_id),))
+    await db.commit()
+    _blacklisted_user_ids.discard(user_id)
+    return len(_blacklisted_user_ids)
 
 
 async def add_warn(user_id: int, server_id: int, moderator_id: int, reason: str) -> int:
@@ -84,29 +180,29 @@ async def add_warn(user_id: int, server_id: int, moderator_id: int, reason: str)
     :param user_id: The ID of the user that should be warned.
     :param reason: The reason why the user should be warned.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        rows = await db.execute(
-            "SELECT id FROM warns WHERE user_id=? AND server_id=? ORDER BY id DESC LIMIT 1",
+    db = await get_connection()
+    rows = await db.execute(
+        "SELECT id FROM warns WHERE user_id=? AND server_id=? ORDER BY id DESC LIMIT 1",
+        (
+            user_id,
+            server_id,
+        ),
+    )
+    async with rows as cursor:
+        result = await cursor.fetchone()
+        warn_id = result[0] + 1 if result is not None else 1
+        await db.execute(
+            "INSERT INTO warns(id, user_id, server_id, moderator_id, reason) VALUES (?, ?, ?, ?, ?)",
             (
+                warn_id,
                 user_id,
                 server_id,
+                moderator_id,
+                reason,
             ),
         )
-        async with rows as cursor:
-            result = await cursor.fetchone()
-            warn_id = result[0] + 1 if result is not None else 1
-            await db.execute(
-                "INSERT INTO warns(id, user_id, server_id, moderator_id, reason) VALUES (?, ?, ?, ?, ?)",
-                (
-                    warn_id,
-                    user_id,
-                    server_id,
-                    moderator_id,
-                    reason,
-                ),
-            )
-            await db.commit()
-            return warn_id
+        await db.commit()
+        return warn_id
 
 
 async def remove_warn(warn_id: int, user_id: int, server_id: int) -> int:
@@ -117,26 +213,26 @@ async def remove_warn(warn_id: int, user_id: int, server_id: int) -> int:
     :param user_id: The ID of the user that was warned.
     :param server_id: The ID of the server where the user has been warned
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute(
-            "DELETE FROM warns WHERE id=? AND user_id=? AND server_id=?",
-            (
-                warn_id,
-                user_id,
-                server_id,
-            ),
-        )
-        await db.commit()
-        rows = await db.execute(
-            "SELECT COUNT(*) FROM warns WHERE user_id=? AND server_id=?",
-            (
-                user_id,
-                server_id,
-            ),
-        )
-        async with rows as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result is not None else 0
+    db = await get_connection()
+    await db.execute(
+        "DELETE FROM warns WHERE id=? AND user_id=? AND server_id=?",
+        (
+            warn_id,
+            user_id,
+            server_id,
+        ),
+    )
+    await db.commit()
+    rows = await db.execute(
+        "SELECT COUNT(*) FROM warns WHERE user_id=? AND server_id=?",
+        (
+            user_id,
+            server_id,
+        ),
+    )
+    async with rows as cursor:
+        result = await cursor.fetchone()
+        return result[0] if result is not None else 0
 
 
 async def get_warnings(user_id: int, server_id: int) -> list:
@@ -147,17 +243,371 @@ async def get_warnings(user_id: int, server_id: int) -> list:
     :param server_id: The ID of the server that should be checked.
     :return: A list of all the warnings of the user.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        rows = await db.execute(
-            "SELECT user_id, server_id, moderator_id, reason, strftime('%s', created_at), id FROM warns WHERE user_id=? AND server_id=?",
-            (
-                user_id,
-                server_id,
-            ),
+    db = await get_connection()
+    rows = await db.execute(
+        "SELECT user_id, server_id, moderator_id, reason, strftime('%s', created_at), id FROM warns WHERE user_id=? AND server_id=?",
+        (
+            user_id,
+            server_id,
+        ),
+    )
+    async with rows as cursor:
+        result = await cursor.fetchall()
+        result_list = []
+        for row in result:
+            result_list.append(row)
+        return result_list
+
+
+async def add_conversation_messages(rows: list[tuple]) -> None:
+    """
+    This function will store a batch of conversation messages.
+
+    :param rows: The (message_id, parent_id, role, content, tokens) of each message.
+    """
+    db = await get_connection()
+    await db.executemany(
+        "INSERT OR REPLACE INTO conversations(message_id, parent_id, role, content, tokens) VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
+    await db.commit()
+
+
+async def remove_conversation_messages(message_ids: list[int]) -> None:
+    """
+    This function will remove a batch of conversation messages.
+
+    :param message_ids: The IDs of the messages that should be removed.
+    """
+    db = await get_connection()
+    await db.executemany(
+        "DELETE FROM conversations WHERE message_id=?",
+        [(message_id,) for message_id in message_ids],
+    )
+    await db.commit()
+
+
+async def get_conversation(message_id: int, limit: int) -> list:
+    """
+    This function will get the chain of messages ending at a message, oldest first.
+
+    :param message_id: The ID of the last message of the chain.
+    :param limit: The maximum number of messages to return.
+    :return: A list of (message_id, parent_id, role, content, tokens) rows.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        """
+        WITH RECURSIVE chain(message_id, parent_id, role, content, tokens, depth) AS (
+            SELECT message_id, parent_id, role, content, tokens, 1
+            FROM conversations WHERE message_id=?
+            UNION ALL
+            SELECT c.message_id, c.parent_id, c.role, c.content, c.tokens, chain.depth + 1
+            FROM conversations AS c JOIN chain ON c.message_id = chain.parent_id
+            WHERE chain.depth < ?
         )
-        async with rows as cursor:
-            result = await cursor.fetchall()
-            result_list = []
-            for row in result:
-                result_list.append(row)
-            return result_list
+        SELECT message_id, parent_id, role, content, tokens FROM chain ORDER BY depth DESC
+        """,
+        (
+            message_id,
+            limit,
+        ),
+    )
+    async with rows as cursor:
+        return list(await cursor.fetchall())
+
+
+async def prune_conversations(max_age_days: float) -> int:
+    """
+    This function will remove the conversation messages older than the given age.
+
+    :param max_age_days: The maximum age of a message, in days.
+    :return: The number of removed messages.
+    """
+    db = await get_connection()
+    cursor = await db.execute(
+        "DELETE FROM conversations WHERE created_at < datetime('now', ?)",
+        (f"-{max_age_days} days",),
+    )
+    await db.commit()
+    return cursor.rowcount
+
+
+async def get_reply_ids(message_id: int) -> list[int]:
+    """
+    This function will get the IDs of the bot replies to a message from the stored conversations.
+
+    :param message_id: The ID of the message that was replied to.
+    :return: A list of the IDs of the replies.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        "SELECT message_id FROM conversations WHERE parent_id=? AND (role IS NULL OR role='assistant')",
+        (message_id,),
+    )
+    async with rows as cursor:
+        result = await cursor.fetchall()
+        return [row[0] for row in result]
+
+
+async def get_summary(key: str) -> Optional[str]:
+    """
+    This function will get a cached summary and mark it as recently used.
+
+    :param key: The content hash of the summarized text.
+    :return: The summary, or None if it is not cached.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        "UPDATE summaries SET used_at=CURRENT_TIMESTAMP WHERE key=? RETURNING summary",
+        (key,),
+    )
+    async with rows as cursor:
+        result = await cursor.fetchone()
+    await db.commit()
+    return result[0] if result is not None else None
+
+
+async def add_summary(key: str, model: str, summary: str) -> int:
+    """
+    This function will store a summary in the cache.
+
+    :param key: The content hash of the summarized text.
+    :param model: The model which wrote the summary.
+    :param summary: The summary.
+    :return: How many bytes the cache grew by.
+    """
+    db = await get_connection()
+    size = len(summary.encode("utf-8"))
+    async with db.execute("SELECT size FROM summaries WHERE key=?", (key,)) as cursor:
+        previous = await cursor.fetchone()
+    await db.execute(
+        "INSERT OR REPLACE INTO summaries(key, model, summary, size) VALUES (?, ?, ?, ?)",
+        (
+            key,
+            model,
+            summary,
+            size,
+        ),
+    )
+    await db.commit()
+    return size - (previous[0] if previous is not None else 0)
+
+
+async def get_summaries_size() -> int:
+    """
+    This function will get the total size of the cached summaries.
+
+    :return: The size of the summaries, in bytes.
+    """
+    db = await get_connection()
+    async with db.execute("SELECT COALESCE(SUM(size), 0) FROM summaries") as cursor:
+        (size,) = await cursor.fetchone()
+        return size
+
+
+async def evict_summaries(max_bytes: int) -> int:
+    """
+    This function will remove the least recently used summaries until the cache fits in the given size.
+
+    :param max_bytes: The maximum total size of the summaries, in bytes.
+    :return: How many bytes were removed.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        """
+        DELETE FROM summaries WHERE key IN (
+            SELECT key FROM (
+                SELECT key, SUM(size) OVER (ORDER BY used_at DESC, rowid DESC) AS total
+                FROM summaries
+            ) WHERE total > ?
+        ) RETURNING size
+        """,
+        (max_bytes,),
+    )
+    async with rows as cursor:
+        result = await cursor.fetchall()
+    await db.commit()
+    return sum(row[0] for row in result)
+
+
+async def get_response(key: str, ttl: float) -> Optional[tuple]:
+    """
+    This function will get a cached response which is not expired, and mark it as recently used.
+
+    :param key: The hash of the normalized prompt, the model and the system messages.
+    :param ttl: The maximum age of the response, in seconds.
+    :return: The (response, model, prompt_tokens, completion_tokens) of the response, or None.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        """
+        UPDATE responses SET used_at=CURRENT_TIMESTAMP
+        WHERE key=? AND created_at >= datetime('now', ?)
+        RETURNING response, model, prompt_tokens, completion_tokens
+        """,
+        (
+            key,
+            f"-{ttl} seconds",
+        ),
+    )
+    async with rows as cursor:
+        result = await cursor.fetchone()
+    await db.commit()
+    return tuple(result) if result is not None else None
+
+
+async def add_response(
+    key: str, response: str, model: str, prompt_tokens: int, completion_tokens: int
+) -> None:
+    """
+    This function will store a response in the cache.
+
+    :param key: The hash of the normalized prompt, the model and the system messages.
+    :param response: The answer of the model.
+    :param model: The model which answered.
+    :param prompt_tokens: The tokens of the prompt.
+    :param completion_tokens: The tokens of the answer.
+    """
+    db = await get_connection()
+    await db.execute(
+        "INSERT OR REPLACE INTO responses(key, response, model, prompt_tokens, completion_tokens) VALUES (?, ?, ?, ?, ?)",
+        (
+            key,
+            response,
+            model,
+            prompt_tokens,
+            completion_tokens,
+        ),
+    )
+    await db.commit()
+
+
+async def evict_responses(max_entries: int, ttl: float) -> int:
+    """
+    This function will remove the expired responses, then the least recently used ones over the limit.
+
+    :param max_entries: The maximum number of cached responses.
+    :param ttl: The maximum age of a response, in seconds.
+    :return: The number of removed responses.
+    """
+    db = await get_connection()
+    expired = await db.execute(
+        "DELETE FROM responses WHERE created_at < datetime('now', ?)",
+        (f"-{ttl} seconds",),
+    )
+    evicted = await db.execute(
+        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used_at DESC, rowid DESC LIMIT -1 OFFSET ?)",
+        (max_entries,),
+    )
+    await db.commit()
+    return expired.rowcount + evicted.rowcount
+
+
+async def add_usage(rows: list[tuple]) -> None:
+    """
+    This function will add a batch of aggregated usage to the stored usage.
+
+    :param rows: The (day, guild_id, user_id, model, requests, prompt_tokens, completion_tokens, cost) of each row.
+    """
+    db = await get_connection()
+    await db.executemany(
+        """
+        INSERT INTO usage(day, guild_id, user_id, model, requests, prompt_tokens, completion_tokens, cost)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(day, guild_id, user_id, model) DO UPDATE SET
+            requests=requests + excluded.requests,
+            prompt_tokens=prompt_tokens + excluded.prompt_tokens,
+            completion_tokens=completion_tokens + excluded.completion_tokens,
+            cost=cost + excluded.cost
+        """,
+        rows,
+    )
+    await db.commit()
+
+
+async def get_usage_totals() -> tuple[int, float]:
+    """
+    This function will get the total usage of all time.
+
+    :return: The total tokens and the total cost.
+    """
+    db = await get_connection()
+    async with db.execute(
+        "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0), COALESCE(SUM(cost), 0.0) FROM usage"
+    ) as cursor:
+        result = await cursor.fetchone()
+        return result[0], result[1]
+
+
+async def get_top_users(days: int, limit: int) -> list:
+    """
+    This function will get the users who spent the most over the last days.
+
+    :param days: How many days, including today, are counted.
+    :param limit: The maximum number of users.
+    :return: The (user_id, requests, tokens, cost) of each user, highest cost first.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        """
+        SELECT user_id, SUM(requests), SUM(prompt_tokens + completion_tokens), SUM(cost)
+        FROM usage WHERE day > date('now', ?) AND user_id != 0
+        GROUP BY user_id ORDER BY SUM(cost) DESC LIMIT ?
+        """,
+        (
+            f"-{days} days",
+            limit,
+        ),
+    )
+    async with rows as cursor:
+        return list(await cursor.fetchall())
+
+
+async def get_daily_usage(days: int) -> list:
+    """
+    This function will get the usage of each of the last days.
+
+    :param days: How many days, including today, are returned.
+    :return: The (day, requests, tokens, cost) of each day, newest first.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        """
+        SELECT day, SUM(requests), SUM(prompt_tokens + completion_tokens), SUM(cost)
+        FROM usage WHERE day > date('now', ?)
+        GROUP BY day ORDER BY day DESC
+        """,
+        (f"-{days} days",),
+    )
+    async with rows as cursor:
+        return list(await cursor.fetchall())
+
+
+async def replace_quota_usage(rows: list[tuple]) -> None:
+    """
+    This function will replace the stored quota usage by the current one.
+
+    :param rows: The (scope, id, window, start, requests, tokens) of each bucket.
+    """
+    db = await get_connection()
+    await db.execute("DELETE FROM quota_usage")
+    await db.executemany(
+        "INSERT INTO quota_usage(scope, id, window, start, requests, tokens) VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    await db.commit()
+
+
+async def get_quota_usage() -> list:
+    """
+    This function will get the stored quota usage.
+
+    :return: The (scope, id, window, start, requests, tokens) of each bucket, oldest first.
+    """
+    db = await get_connection()
+    rows = await db.execute(
+        "SELECT scope, id, window, start, requests, tokens FROM quota_usage ORDER BY start"
+    )
+    async with rows as cursor:
+        return list(await cursor.fetchall())
@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Iterator, Optional, Sequence
+
+from aiohttp import web
+
+# in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+    pairs = ",".join(
+        f'{name}="{escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """
+    The base of the metrics, exported in the Prometheus text format.
+
+    A metric with label names is used through `labels(*values)`; the children
+    are created once and kept, so the hot path only does a dict lookup.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, Metric] = {}
+
+    def labels(self, *values) -> Metric:
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._create_child()
+        return child
+
+    def _create_child(self) -> Metric:
+        return type(self)(self.name, self.help)
+
+    def _iter_children(self) -> Iterator[tuple[tuple, Metric]]:
+        if self.labelnames:
+            yield from list(self._children.items())
+        else:
+            yield (), self
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for values, child in self._iter_children():
+            yield from child._collect_samples(format_labels(self.labelnames, values))
+
+    def _collect_samples(self, labels: str) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    With a callback, the value is read when collected instead, so a counter
+    kept elsewhere (like the hits of a cache) costs nothing on the hot path.
+    """
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _collect_samples(self, labels: str) -> Iterator[str]:
+        value = self.callback() if self.callback is not None else self.value
+        yield f"{self.name}{labels} {value}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # The last count is for the values over the largest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _create_child(self) -> Histogram:
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+    def _collect_samples(self, labels: str) -> Iterator[str]:
+        prefix = labels[:-1] + "," if labels else "{"
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            yield f'{self.name}_bucket{prefix}le="{bucket}"}} {total}'
+        total += self.counts[-1]
+        yield f'{self.name}_bucket{prefix}le="+Inf"}} {total}'
+        yield f"{self.name}_sum{labels} {self.sum}"
+        yield f"{self.name}_count{labels} {total}"
+
+
+class Timer:
+    """
+    Observes the seconds spent in a `with` block; cheaper than a `contextmanager`.
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # A reloaded module gets the metric it registered before.
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], float]] = None,
+    ) -> Counter:
+        counter = self.register(Counter(name, help, labelnames, callback))
+        counter.callback = callback
+        return counter
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], float]] = None,
+    ) -> Gauge:
+        gauge = self.register(Gauge(name, help, labelnames, callback))
+        gauge.callback = callback
+        return gauge
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+LOOP_LAG = REGISTRY.histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+class MetricsServer:
+    """
+    Serves the metrics at http://host:port/metrics, and measures the event
+    loop lag while it runs.
+    """
+
+    def __init__(
+        self,
+        registry: Registry = REGISTRY,
+        host: str = "127.0.0.1",
+        port: int = 9090,
+        lag_interval: float = 0.5,
+    ):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.lag_interval = lag_interval
+        self._runner: Optional[web.AppRunner] = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional[MetricsServer]:
+        port = config.get("metrics_port")
+        if port is None:
+            return None
+        return cls(host=config.get("metrics_host", "127.0.0.1"), port=port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._lag_task = asyncio.create_task(self.measure_lag())
+
+    async def close(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.registry.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def measure_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            LOOP_LAG.observe(max(loop.time() - start - self.lag_interval, 0.0))
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from typing import NamedTuple, Optional
+
+
+class ModelInfo(NamedTuple):
+    context_window: int
+    max_output_tokens: int
+    # in $ per 1000 tokens
+    prompt_price: float
+    completion_price: float
+
+    def get_cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        return (
+            prompt_tokens * self.prompt_price
+            + completion_tokens * self.completion_price
+        ) / 1000
+
+
+# Dated snapshots (e.g. gpt-4-0613) match the longest known prefix.
+MODELS = {
+    "gpt-3.5-turbo": ModelInfo(4096, 4096, 0.0015, 0.002),
+    "gpt-3.5-turbo-16k": ModelInfo(16385, 16385, 0.003, 0.004),
+    "gpt-3.5-turbo-1106": ModelInfo(16385, 4096, 0.001, 0.002),
+    "gpt-3.5-turbo-0125": ModelInfo(16385, 4096, 0.0005, 0.0015),
+    "gpt-4": ModelInfo(8192, 8192, 0.03, 0.06),
+    "gpt-4-32k": ModelInfo(32768, 32768, 0.06, 0.12),
+    "gpt-4-1106-preview": ModelInfo(128000, 4096, 0.01, 0.03),
+    "gpt-4-0125-preview": ModelInfo(128000, 4096, 0.01, 0.03),
+    "gpt-4-turbo-preview": ModelInfo(128000, 4096, 0.01, 0.03),
+    "gpt-4-turbo": ModelInfo(128000, 4096, 0.01, 0.03),
+}
+
+DEFAULT_MODEL_INFO = MODELS["gpt-3.5-turbo"]
+
+
+def get_model_info(model: str, overrides: Optional[dict] = None) -> ModelInfo:
+    """
+    Look up the limits and prices of a model.
+
+    :param overrides: The `openai_models` config, which can add models or
+        change the fields of known ones.
+    """
+    info = DEFAULT_MODEL_INFO
+    for name in sorted(MODELS, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            info = MODELS[name]
+            break
+
+    if overrides and model in overrides:
+        info = info._replace(**overrides[model])
+    return info
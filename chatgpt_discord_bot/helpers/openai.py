@@ -1,11 +1,193 @@
 from __future__ import annotations
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from hashlib import blake2b
+from typing import Optional, Sequence
 
+import httpx
+import openai
 import tiktoken
 
+from chatgpt_discord_bot.helpers.cache import LRUCache
+
+# Keys are fixed-size digests, so the memory of the cache is bounded by its size
+# instead of keeping whole messages (or 64 KB attachments) alive.
+TOKEN_CACHE_SIZE = 16384
+# Below this, a thread pool costs more than it saves.
+BATCH_ENCODE_MIN_CHARS = 16384
+# Above this, the async API encodes in a worker thread instead of blocking the event loop.
+# tiktoken releases the GIL while encoding, so threads are enough.
+OFFLOAD_MIN_CHARS = 8192
+
+_token_cache: LRUCache[tuple[str, bytes], int] = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+_token_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tokenizer")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model)
+
+
+def get_token_cache_key(model: str, text: str) -> tuple[str, bytes]:
+    return model, blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def count_tokens(model: str, text: str) -> int:
+    # Uncached and thread-safe; the cache is only touched from the event loop.
+    return len(get_encoding(model).encode_ordinary(text))
+
+
+def count_tokens_batch(model: str, texts: Sequence[str]) -> list[int]:
+    encoding = get_encoding(model)
+    if sum(map(len, texts)) >= BATCH_ENCODE_MIN_CHARS:
+        encoded = encoding.encode_ordinary_batch(
+            list(texts), num_threads=min(len(texts), 8)
+        )
+    else:
+        encoded = [encoding.encode_ordinary(text) for text in texts]
+    return [len(tokens) for tokens in encoded]
+
 
-@lru_cache(maxsize=256, typed=True)
 def get_tokens(model: str, text: str) -> int:
-    chatgpt_model_encoding = tiktoken.encoding_for_model(model)
-    return len(chatgpt_model_encoding.encode(text))
+    key = get_token_cache_key(model, text)
+    tokens = _token_cache.get(key)
+    if tokens is None:
+        tokens = count_tokens(model, text)
+        _token_cache.put(key, tokens)
+    return tokens
+
+
+async def aget_tokens(model: str, text: str) -> int:
+    if len(text) < OFFLOAD_MIN_CHARS:
+        return get_tokens(model, text)
+
+    key = get_token_cache_key(model, text)
+    tokens = _token_cache.get(key)
+    if tokens is None:
+        loop = asyncio.get_running_loop()
+        tokens = await loop.run_in_executor(_token_executor, count_tokens, model, text)
+        _token_cache.put(key, tokens)
+    return tokens
+
+
+def get_tokens_batch(model: str, texts: Sequence[str]) -> list[int]:
+    keys, tokens, missing = _lookup_tokens_batch(model, texts)
+    if missing:
+        counts = count_tokens_batch(model, [texts[pos] for pos in missing])
+        _store_tokens_batch(keys, tokens, missing, counts)
+    return tokens
+
+
+async def aget_tokens_batch(model: str, texts: Sequence[str]) -> list[int]:
+    keys, tokens, missing = _lookup_tokens_batch(model, texts)
+    if missing:
+        missing_texts = [texts[pos] for pos in missing]
+        if sum(map(len, missing_texts)) < OFFLOAD_MIN_CHARS:
+            counts = count_tokens_batch(model, missing_texts)
+        else:
+            loop = asyncio.get_running_loop()
+            counts = await loop.run_in_executor(
+                _token_executor, count_tokens_batch, model, missing_texts
+            )
+        _store_tokens_batch(keys, tokens, missing, counts)
+    return tokens
+
+
+def _lookup_tokens_batch(model: str, texts: Sequence[str]):
+    keys = [get_token_cache_key(model, text) for text in texts]
+    tokens = [_token_cache.get(key) for key in keys]
+    missing = [pos for pos, count in enumerate(tokens) if count is None]
+    return keys, tokens, missing
+
+
+def _store_tokens_batch(keys, tokens, missing, counts):
+    for pos, count in zip(missing, counts):
+        tokens[pos] = count
+        _token_cache.put(keys[pos], count)
+
+
+def get_token_cache_size() -> int:
+    return len(_token_cache)
+
+
+class OpenAIClientManager:
+    """
+    Owns a single, pooled AsyncOpenAI client shared by every Chat of the bot.
+    """
+
+    def __init__(
+        self,
+        *,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        max_retries: int = 2,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self._client: Optional[openai.AsyncOpenAI] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> OpenAIClientManager:
+        return cls(
+            base_url=config.get("openai_base_url"),
+            timeout=config.get("openai_timeout", 60.0),
+            connect_timeout=config.get("openai_connect_timeout", 5.0),
+            # Retried by `CompletionEngine`, which also falls back to other models.
+            max_retries=0,
+            max_connections=config.get("openai_max_connections", 100),
+            max_keepalive_connections=config.get(
+                "openai_max_keepalive_connections", 20
+            ),
+            keepalive_expiry=config.get("openai_keepalive_expiry", 30.0),
+            http2=config.get("openai_http2", False),
+        )
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        if self._client is None or self._client.is_closed():
+            self._client = self.create_client()
+        return self._client
+
+    def create_client(self) -> openai.AsyncOpenAI:
+        http_client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=self.limits,
+            http2=self.http2 and self.is_http2_available(),
+        )
+        return openai.AsyncOpenAI(
+            # The api key is resolved lazily; `init_openai` sets it after startup.
+            api_key=self.api_key or openai.api_key,
+            base_url=self.base_url,
+            timeout=self.timeout,
+            max_retries=self.max_retries,
+            http_client=http_client,
+        )
+
+    @staticmethod
+    def is_http2_available() -> bool:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    async def aclose(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.close()
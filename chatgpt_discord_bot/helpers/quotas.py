@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Callable, Hashable, Iterable, NamedTuple, Optional
+
+from discord.ext import commands
+
+from chatgpt_discord_bot.exceptions import QuotaExceeded
+
+SCOPES = ("user", "guild", "channel")
+
+
+class QuotaLimit(NamedTuple):
+    scope: str
+    # in seconds
+    window: float
+    tokens: Optional[int] = None
+    requests: Optional[int] = None
+
+
+class SlidingWindow:
+    """
+    Counts the requests and tokens of the last `window` seconds, in buckets of
+    `window / buckets` seconds.
+    """
+
+    def __init__(self, window: float, buckets: int = 60):
+        self.window = window
+        self.bucket_size = max(window / buckets, 1.0)
+        # [start, requests, tokens], oldest first
+        self._buckets: deque[list] = deque()
+        self.requests = 0
+        self.tokens = 0
+
+    def __bool__(self):
+        return bool(self._buckets)
+
+    def __iter__(self):
+        return iter(self._buckets)
+
+    def expire(self, now: float):
+        while (
+            self._buckets
+            and self._buckets[0][0] + self.bucket_size <= now - self.window
+        ):
+            _, requests, tokens = self._buckets.popleft()
+            self.requests -= requests
+            self.tokens -= tokens
+
+    def add(self, now: float, requests: int, tokens: int) -> list:
+        """
+        :return: The bucket the amounts were added to, for `adjust`.
+        """
+        self.expire(now)
+        start = now - now % self.bucket_size
+        if not self._buckets or self._buckets[-1][0] != start:
+            self._buckets.append([start, 0, 0])
+
+        bucket = self._buckets[-1]
+        bucket[1] += requests
+        bucket[2] += tokens
+        self.requests += requests
+        self.tokens += tokens
+        return bucket
+
+    def adjust(self, bucket: list, tokens: int):
+        # An expired bucket no longer counts, so there is nothing to adjust.
+        if any(item is bucket for item in self._buckets):
+            bucket[2] += tokens
+            self.tokens += tokens
+
+    def get_retry_after(
+        self,
+        now: float,
+        requests: int,
+        tokens: int,
+        max_requests: Optional[int],
+        max_tokens: Optional[int],
+    ) -> float:
+        """
+        :return: How many seconds until the amounts fit in the limits, 0 if they do.
+        """
+        self.expire(now)
+        excess_requests = excess_tokens = 0
+        if max_requests is not None:
+            excess_requests = self.requests + requests - max_requests
+        if max_tokens is not None:
+            # Larger requests would wait forever, so they wait for an empty window.
+            excess_tokens = self.tokens + min(tokens, max_tokens) - max_tokens
+
+        if excess_requests <= 0 and excess_tokens <= 0:
+            return 0.0
+
+        for start, bucket_requests, bucket_tokens in self._buckets:
+            excess_requests -= bucket_requests
+            excess_tokens -= bucket_tokens
+            if excess_requests <= 0 and excess_tokens <= 0:
+                return start + self.bucket_size + self.window - now
+        return self.window
+
+
+class Reservation:
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.buckets: list[tuple[SlidingWindow, list]] = []
+
+
+class QuotaEngine:
+    """
+    Enforces sliding-window budgets of requests and tokens per user, guild and
+    channel, before a request is sent to OpenAI.
+
+    A request reserves its estimated prompt tokens up front, and is settled with
+    the tokens it really used once the answer arrives. The windows live in
+    memory and are saved to the database periodically, see `get_rows` and `load`.
+    """
+
+    def __init__(
+        self,
+        limits: Iterable[QuotaLimit] = (),
+        clock: Callable[[], float] = time.time,
+    ):
+        self.limits = list(limits)
+        self.clock = clock
+        # (scope, id, window) -> counts
+        self._windows: dict[tuple, SlidingWindow] = {}
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> QuotaEngine:
+        limits = []
+        for item in config.get("chatgpt_quotas", []):
+            if item["scope"] not in SCOPES:
+                raise ValueError(f"Unknown quota scope: {item['scope']}")
+            limits.append(
+                QuotaLimit(
+                    item["scope"],
+                    item["window"],
+                    item.get("tokens"),
+                    item.get("requests"),
+                )
+            )
+        return cls(limits)
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Quota windows": len(self._windows),
+            "Requests over quota": self.rejected,
+        }
+
+    def check(self, ids: dict[str, Hashable], tokens: int = 0):
+        """
+        :param ids: The id of each scope, like {"user": 1234}; a missing scope is not limited.
+        :raise QuotaExceeded: If a request of the tokens would exceed a limit.
+        """
+        now = self.clock()
+        retry_after = 0.0
+        exceeded: Optional[QuotaLimit] = None
+        for limit in self.limits:
+            key = self._get_key(limit, ids)
+            if key[1] is None:
+                continue
+
+            window = self._windows.get(key)
+            if window is None:
+                # An unknown id has used nothing yet.
+                window = SlidingWindow(limit.window)
+
+            wait = window.get_retry_after(now, 1, tokens, limit.requests, limit.tokens)
+            if wait > retry_after:
+                retry_after, exceeded = wait, limit
+
+        if exceeded is not None:
+            self.rejected += 1
+            raise QuotaExceeded(exceeded.scope, retry_after)
+
+    def reserve(self, ids: dict[str, Hashable], tokens: int) -> Reservation:
+        """
+        Check the quotas, then count a request of the estimated tokens.
+        """
+        self.check(ids, tokens)
+
+        now = self.clock()
+        reservation = Reservation(tokens)
+        keys = {self._get_key(limit, ids): limit for limit in self.limits}
+        for key, limit in keys.items():
+            if key[1] is None:
+                continue
+
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = SlidingWindow(limit.window)
+            reservation.buckets.append((window, window.add(now, 1, tokens)))
+        return reservation
+
+    def settle(self, reservation: Reservation, tokens: int):
+        """
+        Replace the estimated tokens of a reservation by the tokens really used.
+        """
+        delta = tokens - reservation.tokens
+        reservation.tokens = tokens
+        for window, bucket in reservation.buckets:
+            window.adjust(bucket, delta)
+
+    def get_rows(self) -> list[tuple]:
+        """
+        Drop the expired counts and windows.
+
+        :return: The (scope, id, window, start, requests, tokens) of each bucket.
+        """
+        now = self.clock()
+        rows = []
+        for key, window in list(self._windows.items()):
+            window.expire(now)
+            if not window:
+                del self._windows[key]
+                continue
+
+            scope, key_id, _ = key
+            for start, requests, tokens in window:
+                rows.append((scope, key_id, window.window, start, requests, tokens))
+        return rows
+
+    def load(self, rows: Iterable[tuple]):
+        now = self.clock()
+        for scope, key_id, window_size, start, requests, tokens in rows:
+            key = (scope, key_id, window_size)
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = SlidingWindow(window_size)
+            window.add(start, requests, tokens)
+            window.expire(now)
+
+    @staticmethod
+    def _get_key(limit: QuotaLimit, ids: dict[str, Hashable]) -> tuple:
+        return limit.scope, ids.get(limit.scope), limit.window
+
+
+def get_quota_ids(context: commands.Context) -> dict[str, Hashable]:
+    """
+    :return: The id of each scope of the command; the owners of the bot have no quota.
+    """
+    if context.author.id in context.bot.config["owners"]:
+        return {}
+
+    ids = {"user": context.author.id, "channel": context.channel.id}
+    if context.guild is not None:
+        ids["guild"] = context.guild.id
+    return ids
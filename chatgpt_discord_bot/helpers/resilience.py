@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, Sequence, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when every model is skipped because its circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a model after `failure_threshold` failures in a row.
+
+    After `reset_timeout` seconds, a single trial request is let through; the
+    circuit closes again if it succeeds, and stays open for another timeout if not.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        elif self.clock() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        else:
+            return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        elif state == "half-open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            self.opened_at = self.clock()
+        self.trial = False
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    elif isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """
+    :return: The seconds the server asked to wait before retrying, if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        elif "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # An HTTP date; the backoff is used instead.
+        pass
+    return None
+
+
+class CompletionEngine:
+    """
+    Sends a request with retries, hedging, a circuit breaker per model and a
+    chain of fallback models.
+
+    - Retryable errors (timeouts, 429, 5xx) are retried with full-jitter
+      exponential backoff, or after the `Retry-After` the server sent.
+    - If a request takes longer than `hedge_after` seconds, a second identical
+      request is sent and the first answer wins.
+    - Once a model has failed `failure_threshold` times in a row, it is skipped
+      for `reset_timeout` seconds and the next fallback model is used.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_retries: int = 2,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        hedge_after: Optional[float] = None,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Awaitable] = asyncio.sleep,
+        jitter: Callable[[], float] = random.random,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.jitter = jitter
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.retries = 0
+        self.hedges = 0
+        self.fallbacks = 0
+        self.failures = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> CompletionEngine:
+        return cls(
+            max_retries=config.get("openai_max_retries", 2),
+            hedge_after=config.get("openai_hedge_after"),
+            failure_threshold=config.get("openai_circuit_failure_threshold", 5),
+            reset_timeout=config.get("openai_circuit_reset_timeout", 30.0),
+        )
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Retried requests": self.retries,
+            "Hedged requests": self.hedges,
+            "Fallback requests": self.fallbacks,
+            "Failed requests": self.failures,
+            "Open circuits": sum(
+                breaker.state != "closed" for breaker in self.breakers.values()
+            ),
+        }
+
+    def get_breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                self.failure_threshold, self.reset_timeout, self.clock
+            )
+            self.breakers[model] = breaker
+        return breaker
+
+    def get_delay(self, attempt: int, error: BaseException) -> float:
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return self.jitter() * min(self.max_delay, self.base_delay * 2**attempt)
+
+    async def call(
+        self,
+        models: Sequence[str],
+        request: Callable[[str], Awaitable[T]],
+        *,
+        hedge: bool = True,
+    ) -> T:
+        """
+        :param models: The model, then the fallback models in order.
+        :param request: Sends the request to the given model.
+        """
+        error: Optional[BaseException] = None
+        for pos, model in enumerate(models):
+            breaker = self.get_breaker(model)
+            for attempt in range(self.max_retries + 1):
+                if not breaker.allow():
+                    break
+
+                if pos and not attempt:
+                    self.fallbacks += 1
+                elif attempt:
+                    self.retries += 1
+
+                try:
+                    if hedge and self.hedge_after is not None:
+                        result = await self.call_hedged(lambda: request(model))
+                    else:
+                        result = await request(model)
+                except asyncio.CancelledError:
+                    # A cancelled trial says nothing about the model.
+                    breaker.trial = False
+                    raise
+                except Exception as e:
+                    if not is_retryable(e):
+                        # A bad request says nothing about the model either.
+                        breaker.trial = False
+                        raise
+
+                    error = e
+                    breaker.record_failure()
+                    # An open circuit moves on to the next model without waiting.
+                    if attempt < self.max_retries and breaker.state == "closed":
+                        await self.sleep(self.get_delay(attempt, e))
+                    continue
+
+                breaker.record_success()
+                return result
+
+        self.failures += 1
+        if error is None:
+            raise CircuitOpenError(f"No model is available: {', '.join(models)}")
+        raise error
+
+    async def call_hedged(self, request: Callable[[], Awaitable[T]]) -> T:
+        tasks = {asyncio.ensure_future(request())}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                self.hedges += 1
+                tasks.add(asyncio.ensure_future(request()))
+
+            pending = tasks
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
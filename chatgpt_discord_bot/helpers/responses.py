@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import json
+from hashlib import sha256
+from typing import NamedTuple, Optional, Sequence
+
+from chatgpt_discord_bot.helpers import db_manager
+from chatgpt_discord_bot.helpers.cache import LRUCache
+from chatgpt_discord_bot.helpers.models import get_model_info
+
+FRESH_PREFIX = "[fresh]"
+
+
+class CachedResponse(NamedTuple):
+    response: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split()).casefold()
+
+
+def get_response_key(model: str, system_messages: Sequence[str], prompt: str) -> str:
+    data = json.dumps(
+        [model, list(system_messages), normalize_prompt(prompt)], ensure_ascii=False
+    )
+    return sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Caches the answers to single-turn chats, like FAQs or "Hello, world!",
+    in the database with a TTL and least-recently-used eviction.
+
+    An in-memory tier sits in front of the database.
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl: float = 24 * 3600,
+        max_entries: int = 10000,
+        memory_size: int = 256,
+        model_overrides: Optional[dict] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.model_overrides = model_overrides
+        self._memory: LRUCache[str, CachedResponse] = LRUCache(
+            maxsize=memory_size, ttl=ttl
+        )
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_cost = 0.0
+
+    @classmethod
+    def from_config(cls, config: dict) -> ResponseCache:
+        return cls(
+            ttl=config.get("chatgpt_response_cache_ttl", 24 * 3600),
+            max_entries=config.get("chatgpt_response_cache_size", 10000),
+            memory_size=config.get("chatgpt_response_cache_memory_size", 256),
+            model_overrides=config.get("openai_models"),
+        )
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Response cache hits": self.hits,
+            "Response cache misses": self.misses,
+            "Response cache hit rate (%)": round(self.get_hit_rate() * 100),
+            "Tokens saved by the response cache": self.saved_tokens,
+        }
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        cached = self._memory.get(key)
+        if cached is None:
+            row = await db_manager.get_response(key, self.ttl)
+            if row is not None:
+                cached = CachedResponse(*row)
+                self._memory.put(key, cached)
+
+        if cached is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.saved_tokens += cached.prompt_tokens + cached.completion_tokens
+        info = get_model_info(cached.model, self.model_overrides)
+        self.saved_cost += info.get_cost(cached.prompt_tokens, cached.completion_tokens)
+        return cached
+
+    async def put(self, key: str, cached: CachedResponse):
+        self._memory.put(key, cached)
+        await db_manager.add_response(key, *cached)
+
+        # Evicted every so often instead of on every write.
+        self._puts += 1
+        if self._puts % 100 == 1:
+            await db_manager.evict_responses(self.max_entries, self.ttl)
@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class TokenBucket:
+    """
+    Allows `rate` units per second, with bursts of up to `capacity` units.
+    A rate of None never limits.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float],
+        capacity: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.level = capacity
+        self.updated_at = clock()
+
+    def refill(self):
+        now = self.clock()
+        if self.rate is not None:
+            self.level = min(
+                self.capacity, self.level + (now - self.updated_at) * self.rate
+            )
+        self.updated_at = now
+
+    def get_wait(self, amount: float) -> float:
+        """
+        :return: How many seconds until the amount can be taken.
+        """
+        if self.rate is None:
+            return 0.0
+
+        self.refill()
+        # Larger requests would wait forever, so they wait for a full bucket.
+        amount = min(amount, self.capacity)
+        return max(amount - self.level, 0.0) / self.rate
+
+    def take(self, amount: float):
+        if self.rate is None:
+            return
+
+        self.refill()
+        self.level -= min(amount, self.capacity)
+
+    @classmethod
+    def per_minute(
+        cls, limit: Optional[int], clock: Callable[[], float] = time.monotonic
+    ) -> TokenBucket:
+        if not limit:
+            return cls(None, 0, clock)
+        return cls(limit / 60, limit, clock)
+
+
+class ScheduledRequest:
+    def __init__(
+        self,
+        tokens: int,
+        guild_id: Hashable,
+        user_id: Hashable,
+        priority: int,
+        on_position: Optional[Callable[[int], None]],
+    ):
+        self.tokens = tokens
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.priority = priority
+        self.on_position = on_position
+        self.position = 0
+        self.queued = True
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class RequestScheduler:
+    """
+    Sits between the chats and the OpenAI API, so a burst never exceeds the
+    rate limits of the account.
+
+    Requests are admitted by token buckets for requests and tokens per minute
+    and a concurrency limit. Waiting requests are queued by priority, then
+    round-robin over guilds, then over the users of each guild, so one busy
+    guild or user cannot starve the others.
+    """
+
+    def __init__(
+        self,
+        *,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 16,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Awaitable] = asyncio.sleep,
+    ):
+        self.requests = TokenBucket.per_minute(requests_per_minute, clock)
+        self.tokens = TokenBucket.per_minute(tokens_per_minute, clock)
+        self.max_concurrency = max_concurrency
+        self.sleep = sleep
+        # priority -> guild id -> user id -> requests
+        self._queues: dict[int, OrderedDict[Hashable, OrderedDict]] = {}
+        self._queued = 0
+        self._active = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.waited_requests = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> RequestScheduler:
+        return cls(
+            requests_per_minute=config.get("openai_requests_per_minute"),
+            tokens_per_minute=config.get("openai_tokens_per_minute"),
+            max_concurrency=config.get("openai_max_concurrent_requests", 16),
+        )
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Queued requests": self._queued,
+            "Active requests": self._active,
+            "Requests which waited": self.waited_requests,
+        }
+
+    @asynccontextmanager
+    async def request(
+        self,
+        tokens: int,
+        *,
+        guild_id: Hashable = None,
+        user_id: Hashable = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        on_position: Optional[Callable[[int], None]] = None,
+    ) -> AsyncIterator[None]:
+        """
+        Wait for a turn to send a request of the estimated number of tokens.
+
+        :param on_position: Called with the queue position (starting at 1) while
+            the request waits, and with 0 once it is admitted.
+        """
+        request = ScheduledRequest(tokens, guild_id, user_id, priority, on_position)
+        self._enqueue(request)
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            if request.queued:
+                self._remove(request)
+            elif not request.future.cancelled():
+                # Admitted just before the cancellation.
+                self._release()
+            raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def aclose(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _enqueue(self, request: ScheduledRequest):
+        guilds = self._queues.setdefault(request.priority, OrderedDict())
+        users = guilds.setdefault(request.guild_id, OrderedDict())
+        users.setdefault(request.user_id, deque()).append(request)
+        self._queued += 1
+
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+
+    def _remove(self, request: ScheduledRequest):
+        guilds = self._queues[request.priority]
+        users = guilds[request.guild_id]
+        requests = users[request.user_id]
+        requests.remove(request)
+        request.queued = False
+        self._queued -= 1
+        if not requests:
+            del users[request.user_id]
+        if not users:
+            del guilds[request.guild_id]
+        if not guilds:
+            del self._queues[request.priority]
+        self._wakeup.set()
+
+    def _release(self):
+        self._active -= 1
+        self._wakeup.set()
+
+    def _iter_order(self) -> Iterator[ScheduledRequest]:
+        # Replays the round-robin on a copy of the queues.
+        for priority in sorted(self._queues):
+            guilds = OrderedDict(
+                (
+                    guild_id,
+                    OrderedDict(
+                        (user_id, deque(requests))
+                        for user_id, requests in users.items()
+                    ),
+                )
+                for guild_id, users in self._queues[priority].items()
+            )
+            while guilds:
+                yield self._pop(guilds)
+
+    @staticmethod
+    def _pop(guilds: OrderedDict[Hashable, OrderedDict]) -> ScheduledRequest:
+        guild_id, users = next(iter(guilds.items()))
+        user_id, requests = next(iter(users.items()))
+        request = requests.popleft()
+        # The served user and guild go to the back of the line.
+        if requests:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            guilds.move_to_end(guild_id)
+        else:
+            del guilds[guild_id]
+        return request
+
+    def _notify_positions(self):
+        for position, request in enumerate(self._iter_order(), start=1):
+            if request.position != position:
+                request.position = position
+                self._call_on_position(request, position)
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            request = next(self._iter_order(), None)
+            if request is None or self._active >= self.max_concurrency:
+                self._notify_positions()
+                await self._wakeup.wait()
+                continue
+
+            wait = max(self.requests.get_wait(1), self.tokens.get_wait(request.tokens))
+            if wait > 0:
+                self._notify_positions()
+                # The queue is looked at again afterwards, as it may have changed.
+                await self.sleep(wait)
+                continue
+
+            self._pop(self._queues[request.priority])
+            if not self._queues[request.priority]:
+                del self._queues[request.priority]
+            request.queued = False
+            self._queued -= 1
+            if request.future.cancelled():
+                # The waiter was cancelled and will not use its turn.
+                continue
+
+            self._active += 1
+            self.requests.take(1)
+            self.tokens.take(request.tokens)
+            if request.position:
+                self.waited_requests += 1
+                self._call_on_position(request, 0)
+            request.future.set_result(None)
+
+    @staticmethod
+    def _call_on_position(request: ScheduledRequest, position: int):
+        if request.on_position is None:
+            return
+
+        # A failing callback must not stop the dispatcher.
+        try:
+            request.on_position(position)
+        except Exception as e:
+            logger.exception(e)
+
+
+class RequestCoalescer:
+    """
+    Runs one call per key at a time; concurrent callers with the same key
+    share its result instead of sending the same request again.
+
+    The call is cancelled only when every caller waiting for it is cancelled.
+    """
+
+    def __init__(self):
+        # key -> (task, number of waiting callers)
+        self._calls: dict[Hashable, list] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "In-flight requests": len(self._calls),
+            "Coalesced requests": self.coalesced,
+        }
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable]):
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(call())
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, entry))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not task.done():
+                task.cancel()
+                self._forget(key, entry)
+
+    def _forget(self, key: Hashable, entry: list):
+        if self._calls.get(key) is entry:
+            del self._calls[key]
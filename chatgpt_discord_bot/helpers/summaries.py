@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+from hashlib import sha256
+from typing import Awaitable, Callable, Optional
+
+from chatgpt_discord_bot.helpers import db_manager
+from chatgpt_discord_bot.helpers.cache import LRUCache
+
+
+def get_summary_key(model: str, prompt: str, text: str) -> str:
+    digest = sha256()
+    for part in (model, prompt, text):
+        # Length-prefixed, so ("ab", "c") and ("a", "bc") never share a key.
+        data = part.encode("utf-8")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class SummaryCache:
+    """
+    A content-addressed cache of summaries, stored in the database so it survives
+    restarts and is shared by every process using the same database.
+
+    An optional in-memory tier sits in front of it, and concurrent requests for
+    the same key wait for a single summary instead of asking the model twice.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, memory_size: int = 1024):
+        self.max_bytes = max_bytes
+        self._memory: Optional[LRUCache[str, str]] = (
+            LRUCache(maxsize=memory_size) if memory_size else None
+        )
+        # key -> (task, number of waiting callers)
+        self._pending: dict[str, list] = {}
+        # Bytes stored in the database, loaded on first use.
+        self._size: Optional[int] = None
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> SummaryCache:
+        return cls(
+            max_bytes=config.get("chatgpt_summary_cache_bytes", 64 * 1024 * 1024),
+            memory_size=config.get("chatgpt_summary_cache_memory_size", 1024),
+        )
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Summary cache hits": self.hits,
+            "Summary cache memory hits": self.memory_hits,
+            "Summary cache misses": self.misses,
+            "Summary cache bytes": self._size or 0,
+        }
+
+    async def get(self, key: str) -> Optional[str]:
+        if self._memory is not None:
+            summary = self._memory.get(key)
+            if summary is not None:
+                self.hits += 1
+                self.memory_hits += 1
+                return summary
+
+        summary = await db_manager.get_summary(key)
+        if summary is None:
+            return None
+
+        self.hits += 1
+        if self._memory is not None:
+            self._memory.put(key, summary)
+        return summary
+
+    async def put(self, key: str, model: str, summary: str):
+        if self._memory is not None:
+            self._memory.put(key, summary)
+
+        if self._size is None:
+            self._size = await db_manager.get_summaries_size()
+        self._size += await db_manager.add_summary(key, model, summary)
+        if self._size > self.max_bytes:
+            await db_manager.evict_summaries(self.max_bytes)
+            # Re-read, as other processes may write to the same database.
+            self._size = await db_manager.get_summaries_size()
+
+    async def get_or_create(
+        self,
+        model: str,
+        prompt: str,
+        text: str,
+        create: Callable[[], Awaitable[str]],
+    ) -> str:
+        key = get_summary_key(model, prompt, text)
+        entry = self._pending.get(key)
+        if entry is None:
+            summary = await self.get(key)
+            if summary is not None:
+                return summary
+            # Checked again: another caller may have started while the database was read.
+            entry = self._pending.get(key)
+
+        if entry is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._create(key, model, create))
+            entry = self._pending[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            self.hits += 1
+
+        # The summary is shared, so it is cancelled only when every caller is.
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not task.done():
+                task.cancel()
+                self._forget(key, entry)
+
+    async def _create(
+        self, key: str, model: str, create: Callable[[], Awaitable[str]]
+    ) -> str:
+        summary = await create()
+        await self.put(key, model, summary)
+        return summary
+
+    def _forget(self, key: str, entry: list):
+        if self._pending.get(key) is entry:
+            del self._pending[key]
+
+    def clear_memory(self):
+        if self._memory is not None:
+            self._memory.clear()
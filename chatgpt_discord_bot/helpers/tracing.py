@@ -0,0 +1,366 @@
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, ContextManager, Optional, TypeVar
+
+import aiohttp
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_NULL_CONTEXT = nullcontext()
+
+
+class Span:
+    """
+    A timed operation; the spans started inside it, even in other tasks
+    created within it, become its children.
+    """
+
+    __slots__ = (
+        "tracer",
+        "name",
+        "attributes",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "sampled",
+        "start_time",
+        "end_time",
+        "error",
+        "_start",
+        "_token",
+    )
+
+    def __init__(self, tracer: Tracer, name: str, attributes: dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end_time - self.start_time
+
+    def __enter__(self) -> Span:
+        parent = _current_span.get()
+        if parent is None:
+            self.trace_id = os.urandom(16).hex()
+            self.parent_id = None
+            self.sampled = random.random() < self.tracer.sample_rate
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.sampled = parent.sampled
+        self.span_id = os.urandom(8).hex()
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end_time = self.start_time + time.perf_counter() - self._start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        if self.sampled:
+            self.tracer.sink.export(self)
+
+
+class SpanSink:
+    """
+    Receives the finished spans; this one drops them.
+    """
+
+    enabled = False
+
+    def export(self, span: Span):
+        pass
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LoggingSink(SpanSink):
+    enabled = True
+
+    def __init__(self, logger: logging.Logger = logger, level: int = logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def export(self, span: Span):
+        if not self.logger.isEnabledFor(self.level):
+            return
+
+        error = f" ({span.error})" if span.error else ""
+        self.logger.log(
+            self.level,
+            f"{span.name}: {span.duration * 1000:.1f} ms{error} trace={span.trace_id} {span.attributes}",
+        )
+
+
+class OTLPSink(SpanSink):
+    """
+    Exports the spans in batches to an OpenTelemetry collector, as OTLP/HTTP
+    JSON, so no OpenTelemetry package is needed.
+
+    If the collector falls behind, the oldest spans are dropped.
+    """
+
+    enabled = True
+
+    def __init__(
+        self,
+        endpoint: str = "http://127.0.0.1:4318/v1/traces",
+        *,
+        service_name: str = "chatgpt-discord-bot",
+        interval: float = 5.0,
+        max_pending: int = 10000,
+    ):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: list[Span] = []
+        self._task: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, span: Span):
+        if len(self._pending) >= self.max_pending:
+            self._pending.pop(0)
+            self.dropped += 1
+        self._pending.append(span)
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning(f"Failed to export spans: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"Failed to export spans: {e}")
+
+    async def flush(self):
+        spans, self._pending = self._pending, []
+        if not spans:
+            return
+
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.endpoint, json=self.encode(spans)) as resp:
+                resp.raise_for_status()
+        self.exported += len(spans)
+
+    def encode(self, spans: list[Span]) -> dict:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            encode_attribute("service.name", self.service_name)
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [encode_span(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+def encode_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    elif isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    elif isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def encode_span(span: Span) -> dict:
+    data = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # SPAN_KIND_INTERNAL
+        "kind": 1,
+        "startTimeUnixNano": str(int(span.start_time * 1e9)),
+        "endTimeUnixNano": str(int(span.end_time * 1e9)),
+        "attributes": [
+            encode_attribute(key, value) for key, value in span.attributes.items()
+        ],
+        # STATUS_CODE_ERROR or STATUS_CODE_UNSET
+        "status": {"code": 2, "message": span.error} if span.error else {},
+    }
+    if span.parent_id is not None:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+
+class Tracer:
+    """
+    Creates spans around the steps of a request and hands them to a sink.
+
+    With the default no-op sink, `span` returns a shared null context, so the
+    instrumented code pays for a method call and nothing else.
+    """
+
+    def __init__(self, sink: Optional[SpanSink] = None, sample_rate: float = 1.0):
+        self.sink = sink or SpanSink()
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_config(cls, config: dict) -> Tracer:
+        name = config.get("tracing_sink", "none")
+        if name == "none":
+            sink = SpanSink()
+        elif name == "log":
+            sink = LoggingSink()
+        elif name == "otlp":
+            sink = OTLPSink(
+                config.get("tracing_otlp_endpoint", "http://127.0.0.1:4318/v1/traces")
+            )
+        else:
+            raise ValueError(f"Unknown tracing sink: {name}")
+        return cls(sink, sample_rate=config.get("tracing_sample_rate", 1.0))
+
+    def span(self, name: str, **attributes) -> ContextManager:
+        if not self.sink.enabled:
+            return _NULL_CONTEXT
+        return Span(self, name, attributes)
+
+    def traced(
+        self, name: str
+    ) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+        """
+        A decorator which runs each call of a coroutine function in a span.
+        """
+
+        def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs) -> T:
+                with self.span(name):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+class RequestProfiler:
+    """
+    Profiles the next N requests with cProfile, then produces a report.
+
+    cProfile follows the thread, not a task, so the report covers everything
+    the event loop ran from the start of the first request to the end of the last.
+    """
+
+    def __init__(self):
+        self._profile: Optional[cProfile.Profile] = None
+        self._future: Optional[asyncio.Future] = None
+        self._remaining = 0
+        self._active = 0
+        self._requests = 0
+        self._started_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._future is not None
+
+    def start(self, requests: int) -> asyncio.Future:
+        """
+        :return: A future of the report, once the requests are finished.
+        """
+        if self.running:
+            raise RuntimeError("A profile is already running")
+
+        self._profile = cProfile.Profile()
+        self._future = asyncio.get_running_loop().create_future()
+        self._remaining = requests
+        self._requests = 0
+        return self._future
+
+    def cancel(self):
+        if self._profile is not None:
+            self._profile.disable()
+        if self._future is not None and not self._future.done():
+            self._future.cancel()
+        self._profile = self._future = None
+        self._remaining = self._active = 0
+
+    def request(self) -> ContextManager:
+        if not self._remaining:
+            return _NULL_CONTEXT
+        return _ProfiledRequest(self)
+
+    def _enter(self):
+        self._remaining -= 1
+        self._active += 1
+        self._requests += 1
+        if self._requests == 1:
+            self._started_at = time.perf_counter()
+            self._profile.enable()
+
+    def _exit(self):
+        if self._profile is None:
+            # Cancelled while the request ran.
+            return
+
+        self._active -= 1
+        if self._remaining or self._active:
+            return
+
+        self._profile.disable()
+        elapsed = time.perf_counter() - self._started_at
+        stream = io.StringIO()
+        stream.write(f"{self._requests} requests in {elapsed:.3f} s\n\n")
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(100)
+
+        future = self._future
+        self._profile = self._future = None
+        if not future.done():
+            future.set_result(stream.getvalue())
+
+
+class _ProfiledRequest:
+    __slots__ = ("profiler",)
+
+    def __init__(self, profiler: RequestProfiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        self.profiler._enter()
+
+    def __exit__(self, *exc_info):
+        self.profiler._exit()
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from collections import deque
+from pathlib import Path
+from typing import Optional
+
+
+class TranscriptWriter:
+    """
+    Buffers conversation transcripts and appends them to a JSONL file in
+    batches, off the event loop.
+
+    The file is rotated like `logging.handlers.RotatingFileHandler` once it
+    would exceed `max_bytes`; if the writes fall behind, the oldest pending
+    transcripts are dropped instead of growing the buffer without bound.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str | os.PathLike] = "transcripts.jsonl",
+        *,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        max_pending: int = 10000,
+    ):
+        self.path = Path(path) if path else None
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._pending: deque[dict] = deque(maxlen=max_pending)
+        self._lock = asyncio.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> TranscriptWriter:
+        return cls(
+            config.get("chatgpt_transcript_path", "transcripts.jsonl"),
+            max_bytes=config.get("chatgpt_transcript_max_bytes", 10 * 1024 * 1024),
+            backup_count=config.get("chatgpt_transcript_backup_count", 5),
+        )
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Pending transcripts": len(self._pending),
+            "Written transcripts": self.written,
+            "Dropped transcripts": self.dropped,
+        }
+
+    def add(self, transcript: dict):
+        if self.path is None:
+            return
+
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append(transcript)
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        # A slow write must not run twice at the same time.
+        async with self._lock:
+            transcripts = list(self._pending)
+            self._pending.clear()
+            data = "".join(
+                json.dumps(transcript, ensure_ascii=False, default=str) + "\n"
+                for transcript in transcripts
+            ).encode("utf-8")
+            await asyncio.to_thread(self._write, data)
+            self.written += len(transcripts)
+
+    def _write(self, data: bytes):
+        if self.max_bytes and self.path.exists():
+            if self.path.stat().st_size + len(data) > self.max_bytes:
+                self._rotate()
+
+        with self.path.open("ab") as file:
+            file.write(data)
+
+    def _rotate(self):
+        if self.backup_count <= 0:
+            self.path.unlink()
+            return
+
+        for no in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{no}")
+            if source.exists():
+                source.replace(self.path.with_name(f"{self.path.name}.{no + 1}"))
+        self.path.replace(self.path.with_name(f"{self.path.name}.1"))
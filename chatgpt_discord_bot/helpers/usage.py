@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from chatgpt_discord_bot.helpers import db_manager
+
+
+class UsageLedger:
+    """
+    Aggregates the token usage per (day, guild, user, model) in memory, and
+    adds it to the database in batches, so a request never waits on SQLite.
+
+    The totals include what is not flushed yet; queries should `flush` first.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        # (day, guild id, user id, model) -> [requests, prompt tokens, completion tokens, cost]
+        self._pending: dict[tuple, list] = {}
+        self.total_tokens = 0
+        self.total_cost = 0.0
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "Pending usage rows": len(self._pending),
+            "Total tokens": self.total_tokens,
+        }
+
+    async def load(self):
+        """
+        Add the totals stored in the database; only the first call has an effect.
+        """
+        if self.loaded:
+            return
+
+        tokens, cost = await db_manager.get_usage_totals()
+        self.total_tokens += tokens
+        self.total_cost += cost
+        self.loaded = True
+
+    def add(
+        self,
+        guild_id: Optional[int],
+        user_id: Optional[int],
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cost: float,
+    ):
+        """
+        :param guild_id: The guild, or None for direct messages and background requests.
+        :param user_id: The user, or None for background requests like summaries.
+        """
+        day = datetime.fromtimestamp(self.clock(), timezone.utc).date().isoformat()
+        key = (day, guild_id or 0, user_id or 0, model)
+        self._merge(key, [1, prompt_tokens, completion_tokens, cost])
+        self.total_tokens += prompt_tokens + completion_tokens
+        self.total_cost += cost
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        try:
+            await db_manager.add_usage(
+                [(*key, *values) for key, values in pending.items()]
+            )
+        except BaseException:
+            # Kept for the next flush instead of being lost.
+            for key, values in pending.items():
+                self._merge(key, values)
+            raise
+
+    def _merge(self, key: tuple, values: list):
+        row = self._pending.get(key)
+        if row is None:
+            self._pending[key] = list(values)
+        else:
+            for pos, value in enumerate(values):
+                row[pos] += value
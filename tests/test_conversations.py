@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from chatgpt_discord_bot.helpers import db_manager
+from chatgpt_discord_bot.helpers.conversations import ConversationWriter
+
+
+def test_failed_flush_keeps_the_batch(monkeypatch):
+    written = []
+
+    async def fail(rows):
+        raise OSError("disk I/O error")
+
+    async def add(rows):
+        written.extend(rows)
+
+    async def remove(message_ids):
+        pass
+
+    monkeypatch.setattr(db_manager, "remove_conversation_messages", remove)
+    monkeypatch.setattr(db_manager, "add_conversation_messages", fail)
+
+    writer = ConversationWriter()
+    writer.add(1, None, "user", "hello", 1)
+    writer.add(2, 1, "assistant", "hi", 1)
+    with pytest.raises(OSError):
+        asyncio.run(writer.flush())
+    assert len(writer) == 2
+
+    # Newer changes win over the batch which failed.
+    writer.add(2, 1, "assistant", "edited", 1)
+    monkeypatch.setattr(db_manager, "add_conversation_messages", add)
+    asyncio.run(writer.flush())
+    assert sorted(written) == [
+        (1, None, "user", "hello", 1),
+        (2, 1, "assistant", "edited", 1),
+    ]
+    assert len(writer) == 0
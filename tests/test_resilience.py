@@ -0,0 +1,65 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from chatgpt_discord_bot.helpers.resilience import CircuitOpenError, CompletionEngine
+
+
+def make_error(error_class: type, status_code: int) -> openai.APIStatusError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status_code, request=request)
+    return error_class(f"injected {status_code}", response=response, body=None)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def test_bad_request_during_trial_does_not_disable_the_model():
+    clock = FakeClock()
+    engine = CompletionEngine(
+        max_retries=0,
+        failure_threshold=1,
+        reset_timeout=30.0,
+        clock=clock,
+        sleep=clock.sleep,
+    )
+    faults = [
+        make_error(openai.InternalServerError, 500),
+        make_error(openai.BadRequestError, 400),
+    ]
+    calls = []
+
+    async def request(model: str) -> str:
+        calls.append(model)
+        if faults:
+            raise faults.pop(0)
+        return "ok"
+
+    async def run():
+        # Opens the circuit.
+        with pytest.raises(openai.InternalServerError):
+            await engine.call(["model"], request)
+        with pytest.raises(CircuitOpenError):
+            await engine.call(["model"], request)
+
+        # The trial after the cooldown fails with a bad request.
+        clock.now += 30.0
+        with pytest.raises(openai.BadRequestError):
+            await engine.call(["model"], request)
+
+        # The next call is still let through.
+        return await engine.call(["model"], request)
+
+    assert asyncio.run(run()) == "ok"
+    assert len(calls) == 3
+    assert engine.get_breaker("model").state == "closed"